@@ -1,6 +1,8 @@
-import random
+import itertools
+import heapq
 import numpy
 import math
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import matplotlib.pyplot as plt
 
@@ -13,101 +15,383 @@ runs = 1000
 bandits = []
 rounds = 300
 
-#data = pd.DataFrame(index=range(1, runs+1), columns=methods)
-#data = data.fillna(0.0)
-
 epsilons = [0.1, 0.5, 0.9]
-data = pd.DataFrame(index=range(1, runs+1), columns=epsilons)
-data = data.fillna(0.0)
 
 # Parameters (adopted values from slides)
 epsilon = 0.1 # for e-greedy
 c = 2 # for UCB
 
+# Initial belief of every arm per selection method
+initialMeans = {
+    "epsilon-greedy": 0,
+    "initial-optimistic": 150,
+    "ucb": 0
+}
+
+class RewardAccumulator(object):
+    '''Streaming average reward per run and per configuration (method or epsilon),
+    kept in preallocated arrays and only turned into a DataFrame when plotting'''
+
+    def __init__(self, runs, configs):
+        self.runs = runs
+        self.configs = list(configs)
+        self.columns = {config: column for column, config in enumerate(self.configs)}
+
+        # Welford state for every (run, config) pair
+        self.count = numpy.zeros((runs, len(self.configs)), dtype=numpy.int64)
+        self.mean = numpy.zeros((runs, len(self.configs)))
+        self.squares = numpy.zeros((runs, len(self.configs)))
+
+    def add(self, run, config, reward):
+        '''Add a single reward received at the given run (1-based)'''
+        row, column = run - 1, self.columns[config]
+
+        self.count[row, column] += 1
+        delta = reward - self.mean[row, column]
+        self.mean[row, column] += delta / self.count[row, column]
+        self.squares[row, column] += delta * (reward - self.mean[row, column])
+
+    def addBatch(self, run, config, rewards):
+        '''Add the rewards of many rounds received at the same run at once'''
+        row, column = run - 1, self.columns[config]
+        rewards = numpy.asarray(rewards, dtype=float)
+
+        # merge the statistics of the batch into the running ones (Chan et al.)
+        n = len(rewards)
+        batchMean = rewards.mean()
+        batchSquares = ((rewards - batchMean) ** 2).sum()
+
+        count = self.count[row, column] + n
+        delta = batchMean - self.mean[row, column]
+        self.mean[row, column] += delta * n / count
+        self.squares[row, column] += batchSquares + delta ** 2 * self.count[row, column] * n / count
+        self.count[row, column] = count
+
+    def variance(self):
+        '''Sample variance of the reward per run and configuration'''
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(self.count > 1, self.squares / (self.count - 1), numpy.nan)
+
+    def toFrame(self, statistic="mean"):
+        '''The accumulated statistic as a DataFrame with runs as index and configurations as columns'''
+        if statistic == "mean":
+            values = self.mean
+        elif statistic == "variance":
+            values = self.variance()
+        elif statistic == "count":
+            values = self.count
+        else:
+            raise ValueError("Unknown statistic: {}".format(statistic))
+
+        return pd.DataFrame(values, index=range(1, self.runs+1), columns=self.configs)
+
+
+#results = RewardAccumulator(runs, methods)
+results = RewardAccumulator(runs, epsilons)
+
 class BanditArm(object):
     '''Bandit arm'''
 
-    def __init__(self, number):
+    def __init__(self, number, rng=None):
+        if rng is None:
+            rng = numpy.random.default_rng()
+
         self.numberOfArm = number
-        self.trueMean = random.uniform(0, 100)
-        self.sd = 1#random.uniform(1,5)
+        self.trueMean = rng.uniform(0, 100)
+        self.sd = 1#rng.uniform(1,5)
         self.chosen = 0
 
     def setInitialMean(self, method):
-        if method == "epsilon-greedy":
-            self.beliefMean = 0
-        elif method == "initial-optimistic":
-            self.beliefMean = 150
-        elif method == "ucb":
-            self.beliefMean = 0
+        if method in initialMeans:
+            self.beliefMean = initialMeans[method]
         else:
             print("No valid selection mechanism found")
 
-def initialize(method):
+class GreedyIndex(object):
+    '''Segment tree over the belief means of all arms. The greedy arm is read off
+    the root and a pull only updates the path above its leaf, so selection costs
+    O(log k) instead of a scan over all k arms.'''
+
+    def __init__(self, beliefMeans):
+        self.size = 1
+        while self.size < len(beliefMeans):
+            self.size *= 2
+
+        self.beliefMeans = list(beliefMeans) + [-math.inf] * (self.size - len(beliefMeans))
+
+        # every node holds the best arm below it
+        self.tree = [0] * self.size + list(range(self.size))
+        for node in range(self.size-1, 0, -1):
+            self.tree[node] = self.better(self.tree[2*node], self.tree[2*node+1])
+
+    def better(self, left, right):
+        '''The left (lower numbered) arm wins ties, like a scan in arm order'''
+        if self.beliefMeans[right] > self.beliefMeans[left]:
+            return right
+        return left
+
+    def best(self):
+        return self.tree[1]
+
+    def update(self, arm, beliefMean):
+        self.beliefMeans[arm] = beliefMean
+
+        node = (self.size + arm) // 2
+        while node:
+            self.tree[node] = self.better(self.tree[2*node], self.tree[2*node+1])
+            node //= 2
+
+class UCBIndex(object):
+    '''Index for UCB selection. The log(t) term changes every run, so scores are not
+    stored; instead arms are bucketed by the number of times they were chosen.
+    Arms in one bucket share the same exploration bonus, so only the arm with the
+    highest belief in each bucket (the top of its heap) is scored at time t.
+    Heap entries are invalidated lazily when an arm is pulled again.'''
+
+    def __init__(self, arms, c):
+        self.c = c
+        self.chosen = [0] * arms
+        self.version = [0] * arms
+        self.untried = list(range(arms))
+        self.buckets = {}
+
+    def best(self, t):
+
+        # untried arms have an infinite upper bound; the lowest numbered one goes first
+        while self.untried and self.chosen[self.untried[0]] > 0:
+            heapq.heappop(self.untried)
+        if self.untried:
+            return self.untried[0]
+
+        selectedArm, maxUpperBound = None, -math.inf
+        for chosen in list(self.buckets):
+            bucket = self.buckets[chosen]
+
+            # drop entries of arms that have been pulled since
+            while bucket and bucket[0][2] != self.version[bucket[0][1]]:
+                heapq.heappop(bucket)
+            if not bucket:
+                del self.buckets[chosen]
+                continue
+
+            negativeMean, arm, _ = bucket[0]
+            upperBound = -negativeMean + self.c * math.sqrt(math.log(t)/(2*chosen))
+
+            if upperBound > maxUpperBound or (upperBound == maxUpperBound and arm < selectedArm):
+                selectedArm, maxUpperBound = arm, upperBound
+
+        return selectedArm
+
+    def update(self, arm, beliefMean, chosen):
+        self.chosen[arm] = chosen
+        self.version[arm] += 1
+        heapq.heappush(self.buckets.setdefault(chosen, []), (-beliefMean, arm, self.version[arm]))
+
+def initialize(method, rng=None):
     '''Initialize arms and store in array'''
 
+    if rng is None:
+        rng = numpy.random.default_rng()
+
     del bandits[:]
 
     for arm in range(arms):
-        bandit = BanditArm(arm)
+        bandit = BanditArm(arm, rng)
         bandit.setInitialMean(method)
         bandits.append(bandit)
 
-def run(method):
+def run(method, accumulator=None, config=None, rng=None):
+
+    if accumulator is None:
+        accumulator = results
+    if config is None:
+        config = epsilon
+    if rng is None:
+        rng = numpy.random.default_rng()
+
+    # draw all randomness of this round up front, one value per run
+    explorationDraws = rng.uniform(0, 1, runs).tolist()
+    randomArms = rng.integers(0, len(bandits), runs).tolist()
+    rewardNoise = rng.standard_normal(runs).tolist()
+
+    # arm-selection index, updated after every pull
+    if method == "ucb":
+        index = UCBIndex(len(bandits), c)
+    else:
+        index = GreedyIndex([bandit.beliefMean for bandit in bandits])
 
     for run in range(1, runs+1):
 
         # select action
         if method == "initial-optimistic":
             '''Action is fully greedy: the highest beliefMean is selected'''
-            beliefMean = 0
-            for bandit in bandits:
-                if bandit.beliefMean > beliefMean:
-                    selectedBandit = bandit
-                    beliefMean = bandit.beliefMean
+            selectedBandit = bandits[index.best()]
 
         elif method == "epsilon-greedy":
             '''A random arm is selected with probability epsilon; the greedy action is executed otherwise'''
-            prob = random.uniform(0,1)
+            prob = explorationDraws[run-1]
             if prob <= epsilon:
-                selectedBandit = bandits[random.randint(0, arms-1)]
+                selectedBandit = bandits[randomArms[run-1]]
             else:
-                beliefMean = -1
-                for bandit in bandits:
-                    if bandit.beliefMean > beliefMean:
-                        selectedBandit = bandit
-                        beliefMean = bandit.beliefMean
+                selectedBandit = bandits[index.best()]
 
         elif method == "ucb":
             '''The arm with the highest upper-bound confidence value is selected'''
-            maxUpperBound = -1
-            for bandit in bandits:
-                if bandit.chosen == 0:
-                    upperBound = 1e400 # upper bound set to infinitely large value (so that bandit is chosen)
-                else:
-                    upperBound = bandit.beliefMean + c * math.sqrt(math.log(run)/(2*bandit.chosen)) # formula from slides
-
-                if upperBound > maxUpperBound:
-                    selectedBandit = bandit
-                    maxUpperBound = upperBound
+            selectedBandit = bandits[index.best(run)]
 
         else:
             print("Missing method")
             break
 
         selectedBandit.chosen += 1
-        reward = numpy.random.normal(selectedBandit.trueMean, selectedBandit.sd)
+        reward = selectedBandit.trueMean + selectedBandit.sd * rewardNoise[run-1]
 
-        # update the average reward at this run (over all rounds) in the dataset
-        #data.at[run, method] = (data.at[run, method] * round + reward) / (round + 1)
-        data.at[run, epsilon] = (data.at[run, epsilon] * round + reward) / (round + 1)
+        # update the average reward at this run (over all rounds)
+        accumulator.add(run, config, reward)
 
 
         # updating belief status (formula from slides)
         selectedBandit.beliefMean = selectedBandit.beliefMean + 1 / (selectedBandit.chosen + 1) * (reward - selectedBandit.beliefMean)
 
+        if method == "ucb":
+            index.update(selectedBandit.numberOfArm, selectedBandit.beliefMean, selectedBandit.chosen)
+        else:
+            index.update(selectedBandit.numberOfArm, selectedBandit.beliefMean)
+
+
+def run_batched(method, rounds=rounds, arms=arms, runs=runs, epsilon=epsilon, c=c, rng=None,
+                accumulator=None, config=None):
+    '''Simulate all rounds at once. True means, belief means and pull counts are
+    kept as (rounds x arms) arrays and every round takes its pull at the same
+    time. Returns the average reward (over all rounds) at each run; the rewards
+    are also added to the accumulator under config when one is given.'''
+
+    if method not in initialMeans:
+        raise ValueError("No valid selection mechanism found: {}".format(method))
+
+    if rng is None:
+        rng = numpy.random.default_rng()
+
+    # one row of arms per round
+    trueMeans = rng.uniform(0, 100, size=(rounds, arms))
+    beliefMeans = numpy.full((rounds, arms), float(initialMeans[method]))
+    chosen = numpy.zeros((rounds, arms), dtype=numpy.int64)
+    sd = 1
+
+    # flat views so a pull in every round is a single fancy-indexed operation
+    trueFlat = trueMeans.ravel()
+    beliefFlat = beliefMeans.ravel()
+    chosenFlat = chosen.ravel()
+    rowOffset = numpy.arange(rounds) * arms
+
+    if method == "ucb":
+        # 1 / sqrt(2 * chosen), kept up to date per pull; untried arms are selected explicitly below
+        inverseSpread = numpy.zeros((rounds, arms))
+        inverseFlat = inverseSpread.ravel()
+        upperBounds = numpy.empty((rounds, arms))
+
+    averageReward = numpy.zeros(runs)
+
+    for run in range(1, runs+1):
+
+        # select action in every round (argmax picks the first arm on ties, as run() does)
+        if method == "initial-optimistic":
+            selected = beliefMeans.argmax(axis=1)
+
+        elif method == "epsilon-greedy":
+            selected = beliefMeans.argmax(axis=1)
+            explore = rng.uniform(0, 1, rounds) <= epsilon
+            selected[explore] = rng.integers(0, arms, explore.sum())
 
-def visualize_all():
+        elif method == "ucb":
+            if run == 1:
+                # nothing has been tried yet, so the first arm is chosen everywhere
+                selected = numpy.zeros(rounds, dtype=numpy.intp)
+            else:
+                numpy.multiply(inverseSpread, c * math.sqrt(math.log(run)), out=upperBounds)
+                upperBounds += beliefMeans
+                # untried arms come first (not inf * bonus, which is NaN when c is 0)
+                numpy.copyto(upperBounds, numpy.inf, where=chosen == 0)
+                selected = upperBounds.argmax(axis=1)
+
+        pulled = rowOffset + selected
+
+        chosenFlat[pulled] += 1
+        reward = trueFlat[pulled] + sd * rng.standard_normal(rounds)
+
+        averageReward[run-1] = reward.mean()
+        if accumulator is not None:
+            accumulator.addBatch(run, config, reward)
+
+        # updating belief status (same formula as run())
+        beliefMean = beliefFlat[pulled]
+        beliefFlat[pulled] = beliefMean + 1 / (chosenFlat[pulled] + 1) * (reward - beliefMean)
+
+        if method == "ucb":
+            inverseFlat[pulled] = 1 / numpy.sqrt(2 * chosenFlat[pulled])
+
+    return averageReward
+
+
+sweepParameters = ["method", "epsilon", "c", "arms", "runs", "rounds"]
+
+def configurations(grid):
+    '''Expand a grid of parameter values into a list of configurations. The grid is
+    either a dict mapping parameters to lists of values (all combinations are taken)
+    or a list of dicts; parameters that are left out get the module defaults.'''
+
+    defaults = {"method": method, "epsilon": epsilon, "c": c, "arms": arms, "runs": runs, "rounds": rounds}
+
+    if isinstance(grid, dict):
+        for parameter in grid:
+            if parameter not in defaults:
+                raise ValueError("Unknown sweep parameter: {}".format(parameter))
+        keys = list(grid)
+        grid = [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+    configs = []
+    for config in grid:
+        full = dict(defaults)
+        full.update(config)
+        configs.append(full)
+
+    return configs
+
+def run_config(config, seed):
+    '''Worker for sweep(): run one configuration with its own random stream'''
+
+    accumulator = RewardAccumulator(config["runs"], [0])
+    run_batched(config["method"], rounds=config["rounds"], arms=config["arms"], runs=config["runs"],
+                epsilon=config["epsilon"], c=config["c"], rng=numpy.random.default_rng(seed),
+                accumulator=accumulator, config=0)
+
+    return accumulator.mean[:, 0], numpy.sqrt(accumulator.variance()[:, 0])
+
+def sweep(grid, seed=None, workers=None):
+    '''Run every configuration of the grid on a process pool. Each configuration gets
+    an independent child of one SeedSequence, so a sweep with a fixed seed gives
+    the same table regardless of the number of workers. Returns a tidy DataFrame
+    with one row per configuration and run.'''
+
+    configs = configurations(grid)
+    seeds = numpy.random.SeedSequence(seed).spawn(len(configs))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(run_config, configs, seeds))
+
+    tables = []
+    for config, (mean, sd) in zip(configs, outcomes):
+        table = pd.DataFrame({"run": numpy.arange(1, config["runs"]+1), "reward": mean, "sd": sd})
+        for parameter in reversed(sweepParameters):
+            table.insert(0, parameter, config[parameter])
+        tables.append(table)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def visualize_all(data=None):
+    if data is None:
+        data = results.toFrame()
     ax = plt.gca()
 
     data.plot(kind='line', y='epsilon-greedy', color='blue',ax=ax, title="k-armed Bandit using 3 Forms of Exploration/Exploitation")
@@ -116,7 +400,9 @@ def visualize_all():
 
     plt.show()
 
-def visualize_egreedy():
+def visualize_egreedy(data=None):
+    if data is None:
+        data = results.toFrame()
     ax = plt.gca()
 
     data.plot(kind='line', y=0.1, color='#d9f0a3',ax=ax, title="k-armed Bandit using the epsilon-greedy method")
@@ -135,19 +421,8 @@ def visualize_egreedy():
 
 if __name__ == '__main__':
 
-    # for method in methods:
-    #     print(method)
-    #     for round in range(rounds):
-    #         initialize(method)
-    #         run(method)
-    #
-    # visualize_all()
-
-
-    for eps in epsilons:
-        epsilon = eps
-        for round in range(rounds):
-            initialize("epsilon-greedy")
-            run("epsilon-greedy")
+    # table = sweep({"method": methods})
+    # visualize_all(table.pivot(index="run", columns="method", values="reward"))
 
-    visualize_egreedy()
+    table = sweep({"method": ["epsilon-greedy"], "epsilon": epsilons})
+    visualize_egreedy(table.pivot(index="run", columns="epsilon", values="reward"))
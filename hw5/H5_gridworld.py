@@ -1,5 +1,6 @@
 import numpy as np
-import random
+from mdp import GridSpec, compile_gridworld, policy_matrix, grid_values, store_values, policy_indices, store_policies
+from dp import evaluate, improve_policy, solve
 
 grid_columns = 4
 grid_rows = 4
@@ -33,156 +34,92 @@ class State():
     def __str__(self):
         return str(self.value)
 
-def determine_possible_states(action, state_considered, gametype):
+def gridworld_spec(gametype='infinite', rows=grid_rows+1, columns=grid_columns+1):
 
-    if action == "N":
-        move_to = np.add(state_considered.position, [-1, 0])
-    elif action == "S":
-        move_to = np.add(state_considered.position, [1, 0])
-    elif action == "W":
-        move_to = np.add(state_considered.position, [0, -1])
-    elif action == "E":
-        move_to = np.add(state_considered.position, [0, 1])
+    '''The special cells and rewards of the game on a grid of the given size'''
 
-    # The special moves in infinite vs episodic games
     if gametype == 'infinite':
-        if state_considered.position == [0, 1]:
-            new_state = grid[4][1]
-            reward = 10
-            return [reward, new_state]
-        elif state_considered.position == [0, 3]:
-            new_state = grid[2][3]
-            reward = 5
-            return [reward, new_state]
+        # every move out of A or B teleports with a reward
+        return GridSpec(rows, columns, teleports={(0, 1): ((rows-1, 1), 10), (0, 3): ((rows//2, 3), 5)})
 
     elif gametype == 'episodic':
-        if state_considered.position == [0, 1]:
-            new_state = grid[0][1]
-            reward = 0
-            return [reward, new_state]
-        elif state_considered.position == [0, 3]:
-            new_state = grid[0][3]
-            reward = 0
-            return [reward, new_state]
-        elif move_to[0] == 0 and move_to[1] == 1:
-            new_state = grid[0][1]
-            reward = 10
-            return [reward, new_state]
-        elif move_to[0] == 0 and move_to[1] == 3:
-            new_state = grid[0][3]
-            reward = 5
-            return [reward, new_state]
-
-    # Regular/off-the-grid moves
-
-    if move_to[0] <= 4 and move_to[0] >= 0 and move_to[1] <= 4 and move_to[1] >= 0: # ordinary move
-        new_state = grid[move_to[0]][move_to[1]]
-        reward = 0
-    else: # move impossible
-        new_state = state_considered
-        reward = -1
-
-    return [reward, new_state]
-
-def evaluate_policy(gametype='infinite'):
-
-    if gametype == 'episodic':
-        global discount_factor
-        discount_factor = 1.0
+        # A and B are absorbing; moving into them is rewarded
+        return GridSpec(rows, columns, terminals=[(0, 1), (0, 3)], entry_rewards={(0, 1): 10, (0, 3): 5})
 
-    # Following pseudocode of Barto & Sutton p. 63
+    raise ValueError("Unknown game type: {}".format(gametype))
 
-    round = 0
-    while True:
+specs = {gametype: gridworld_spec(gametype) for gametype in ['infinite', 'episodic']}
 
-        change = 0
+def determine_possible_states(action, state_considered, gametype):
 
-        # look at each state
-        for row in range(grid_rows+1):
+    reward, move_to = specs[gametype].transition(state_considered.position, action)
 
-            for column in range(grid_columns+1):
+    return [reward, grid[move_to[0]][move_to[1]]]
 
-                state_considered = grid[row][column]
+models = {}
 
-                old_value = state_considered.value
-                updated_value = 0
+def compile_model(gametype='infinite'):
 
-                # look at all possible actions
-                if state_considered.policy == "random":
-                    possible_policies = policy
-                else:
-                    possible_policies = state_considered.policy
+    '''Compile the transitions of a game type into arrays; this happens only once'''
 
-                for action in possible_policies:
+    if gametype not in models:
+        models[gametype] = compile_gridworld(specs[gametype], policy)
 
-                    outcomes_of_action = determine_possible_states(action, state_considered, gametype)
+    return models[gametype]
 
-                    reward = outcomes_of_action[0]
-                    value_new_state = outcomes_of_action[1].value
+def evaluate_policy(gametype='infinite', mode='sweep'):
 
-                    updated_value += 0.25 * (reward + discount_factor * value_new_state)
+    '''Evaluate the policies in the grid; mode is one of "sweep", "solve" or "gmres"
+    (see dp.evaluate). Returns the result with its iteration count and timing.'''
 
-                change = max(change, np.abs(updated_value - old_value)) # however value function changed
+    if gametype == 'episodic':
+        global discount_factor
+        discount_factor = 1.0
 
-                state_considered.value = updated_value
+    if grid is None:
+        reset_grid()
 
-        if change < threshold:
-            break
+    # Following pseudocode of Barto & Sutton p. 63, sweeping all states at once
 
-def policy_update(action, state_considered, gametype):
+    model = compile_model(gametype)
+    result = evaluate(model, policy_matrix(grid, policy), discount_factor, mode, threshold, grid_values(grid))
 
-    outcomes_of_action = determine_possible_states(action, state_considered, gametype)
-    reward_current_action = outcomes_of_action[0]
-    value_new_state = outcomes_of_action[1].value
+    store_values(grid, result.values)
 
-    value_of_action = reward_current_action + discount_factor * value_new_state
+    return result
 
-    return value_of_action
+def greedify(gametype='infinite', mode='sweep', solver='policy-iteration', sweeps=5):
 
-def greedify(gametype='infinite'):
+    '''Make the policies in the grid optimal. The default solver is policy iteration
+    with full evaluations in the given mode; solver can also be "value-iteration"
+    or "modified-policy-iteration" (evaluating with only the given number of sweeps).'''
 
     if gametype == 'episodic':
         global discount_factor
         discount_factor = 1.0
 
-    while True:
-        evaluate_policy(gametype)
-
-        # Following pseudocode of Sutton & Barto p. 65
-
-        policy_stable = True
-
-        # consider each state
-        for row in range(grid_rows+1):
-
-            for column in range(grid_columns+1):
-
-                state_considered = grid[row][column]
-
-                # the action taken using the current policy
-                old_policy = state_considered.policy
+    if grid is None:
+        reset_grid()
 
-                # the value of this action
-                if old_policy == "random":
-                    value_of_action = -1000000000000
-                else: # look ahead one step
-                    value_of_action = state_considered.value
+    model = compile_model(gametype)
 
+    if solver != 'policy-iteration':
+        result = solve(model, discount_factor, solver, threshold, grid_values(grid), sweeps_per_evaluation=sweeps)
+        store_values(grid, result.values)
+        store_policies(grid, result.policy, policy)
+        return result
 
-                new_policy = old_policy
-
-                for action in policy:
+    while True:
+        evaluate_policy(gametype, mode)
 
-                    reward = policy_update(action, state_considered, gametype)
+        # Following pseudocode of Sutton & Barto p. 65, for all states at once
 
-                    if reward > value_of_action:
-                        value_of_action = reward
-                        new_policy = action
+        old_policy = policy_indices(grid, policy)
+        new_policy = improve_policy(model, grid_values(grid), discount_factor, old_policy, threshold)
 
-                state_considered.policy = new_policy
+        store_policies(grid, new_policy, policy)
 
-                if new_policy != old_policy:
-                    policy_stable = False
+        policy_stable = np.array_equal(new_policy, old_policy)
 
         if policy_stable:
             break
@@ -204,10 +141,19 @@ def print_grid_policies(grid):
         print("")
 
 
-grid = initialize_grid(grid_rows, grid_columns)
+grid = None
+
+def reset_grid():
+
+    '''(Re)build the grid of states that holds the values and policies'''
+
+    global grid
+    grid = initialize_grid(grid_rows, grid_columns)
 
 def main():
 
+    reset_grid()
+
     # Policy evaluation for infinite game
     print("Policy evaluation of a random probabilistic policy in infinity")
     evaluate_policy()
@@ -1,5 +1,6 @@
 import numpy as np
-import random
+from mdp import GridSpec, compile_gridworld, policy_matrix, grid_values, store_values, policy_indices, store_policies
+from dp import evaluate, improve_policy, solve
 
 grid_columns = 4
 grid_rows = 4
@@ -33,140 +34,75 @@ class State():
     def __str__(self):
         return str(self.value)
 
-def determine_possible_states(action, state_considered):
-
-    # The absorbing states
-
-    if state_considered.position == [0, 1]:
-        new_state = grid[0][1]
-        reward = 0
-        return [reward, new_state]
-    elif state_considered.position == [0, 3]:
-        new_state = grid[0][3]
-        reward = 0
-        return [reward, new_state]
-
-    if action == "N":
-        move_to = np.add(state_considered.position, [-1, 0])
-    elif action == "S":
-        move_to = np.add(state_considered.position, [1, 0])
-    elif action == "W":
-        move_to = np.add(state_considered.position, [0, -1])
-    elif action == "E":
-        move_to = np.add(state_considered.position, [0, 1])
-
-
-    # Result of the moves
-
-    if move_to[0] == 0 and move_to[1] == 1:
-        new_state = grid[0][1]
-        reward = 10
-    elif move_to[0] == 0 and move_to[1] == 3:
-        new_state = grid[0][3]
-        reward = 5
-    elif move_to[0] <= 4 and move_to[0] >= 0 and move_to[1] <= 4 and move_to[1] >= 0: # ordinary move
-        new_state = grid[move_to[0]][move_to[1]]
-        reward = 0
-    else: # move impossible
-        new_state = state_considered
-        reward = -1
-
-    return [reward, new_state]
-
-def evaluate_policy():
-
-    # Following pseudocode of Barto & Sutton p. 63
-
-    round = 0
-    while True:
-
-        change = 0
-
-        # look at each state
-        for row in range(grid_rows+1):
-
-            for column in range(grid_columns+1):
-
-                state_considered = grid[row][column]
-
-                old_value = state_considered.value
-                updated_value = 0
-
-                # look at all possible actions
-                if state_considered.policy == "random":
-                    possible_policies = policy
-                else:
-                    possible_policies = state_considered.policy
+# A and B are absorbing; moving into them is rewarded
+spec = GridSpec(grid_rows+1, grid_columns+1, terminals=[(0, 1), (0, 3)], entry_rewards={(0, 1): 10, (0, 3): 5})
 
-                for action in possible_policies:
-
-                    outcomes_of_action = determine_possible_states(action, state_considered)
-
-                    reward = outcomes_of_action[0]
-                    value_new_state = outcomes_of_action[1].value
+def determine_possible_states(action, state_considered):
 
-                    updated_value += 0.25 * (reward + discount_factor * value_new_state)
+    reward, move_to = spec.transition(state_considered.position, action)
 
-                change = max(change, np.abs(updated_value - old_value)) # however value function changed
+    return [reward, grid[move_to[0]][move_to[1]]]
 
-                state_considered.value = updated_value
+model = None
 
-        if change < threshold:
-            print("Evaluation completed; moving to greedification")
-            break
+def compile_model():
 
-def policy_update(action, state_considered):
+    '''Compile the transitions of the game into arrays; this happens only once'''
 
-    outcomes_of_action = determine_possible_states(action, state_considered)
-    reward_current_action = outcomes_of_action[0]
-    value_new_state = outcomes_of_action[1].value
+    global model
 
-    value_of_action = reward_current_action + discount_factor * value_new_state
+    if model is None:
+        model = compile_gridworld(spec, policy)
 
-    return value_of_action
+    return model
 
-def greedify():
+def evaluate_policy(mode='sweep'):
 
-    while True:
-        evaluate_policy()
+    '''Evaluate the policies in the grid; only the "sweep" mode of dp.evaluate
+    applies, as the episodic game is undiscounted. Returns the result with its
+    iteration count and timing.'''
 
-        # Following pseudocode of Sutton & Barto p. 65
+    if grid is None:
+        reset_grid()
 
-        policy_stable = True
+    # Following pseudocode of Barto & Sutton p. 63, sweeping all states at once
 
-        # consider each state
-        for row in range(grid_rows+1):
+    result = evaluate(compile_model(), policy_matrix(grid, policy), discount_factor, mode, threshold, grid_values(grid))
 
-            for column in range(grid_columns+1):
+    store_values(grid, result.values)
+    print("Evaluation completed; moving to greedification")
 
-                state_considered = grid[row][column]
+    return result
 
-                # the action taken using the current policy
-                old_policy = state_considered.policy
+def greedify(mode='sweep', solver='policy-iteration', sweeps=5):
 
-                # the value of this action
-                if old_policy == "random":
-                    value_of_action = -1000000000000
-                else: # look ahead one step
-                    value_of_action = state_considered.value #policy_update(old_policy, state_considered)
+    '''Make the policies in the grid optimal. The default solver is policy iteration
+    with full evaluations in the given mode; solver can also be "value-iteration"
+    or "modified-policy-iteration" (evaluating with only the given number of sweeps).'''
 
+    if grid is None:
+        reset_grid()
 
-                new_policy = old_policy
+    compiled = compile_model()
 
-                #np.random.shuffle(policy) # dit breekt het hele ding, waarom?
+    if solver != 'policy-iteration':
+        result = solve(compiled, discount_factor, solver, threshold, grid_values(grid), sweeps_per_evaluation=sweeps)
+        store_values(grid, result.values)
+        store_policies(grid, result.policy, policy)
+        print("The policy has stabilized")
+        return result
 
-                for action in policy:
+    while True:
+        evaluate_policy(mode)
 
-                    reward = policy_update(action, state_considered)
+        # Following pseudocode of Sutton & Barto p. 65, for all states at once
 
-                    if reward > value_of_action:
-                        value_of_action = reward
-                        new_policy = action
+        old_policy = policy_indices(grid, policy)
+        new_policy = improve_policy(compiled, grid_values(grid), discount_factor, old_policy, threshold)
 
-                state_considered.policy = new_policy
+        store_policies(grid, new_policy, policy)
 
-                if new_policy != old_policy:
-                    policy_stable = False
+        policy_stable = np.array_equal(new_policy, old_policy)
 
         if policy_stable:
             print("The policy has stabilized")
@@ -188,11 +124,18 @@ def print_grid_policies(grid):
             print(" | ", end = '')
         print("")
 
-grid = initialize_grid(grid_rows, grid_columns)
+grid = None
+
+def reset_grid():
+
+    '''(Re)build the grid of states that holds the values and policies'''
 
+    global grid
+    grid = initialize_grid(grid_rows, grid_columns)
 
 def main():
 
+    reset_grid()
 
     # Policy evaluation
     print("Policy evaluation of a random probabilistic policy")
@@ -0,0 +1,47 @@
+'''
+Scaling benchmark for the DP solvers: compiles the infinite gridworld at
+growing sizes and times random-policy evaluation, value iteration and
+prioritized sweeping on the compiled arrays. For small grids the compilation through State objects is
+timed as well, to show the per-state overhead it avoids.
+'''
+
+import time
+import numpy as np
+from mdp import compile_grid, compile_gridworld
+from dp import evaluate, solve
+import H5_gridworld as gridworld
+
+sizes = [5, 50, 100, 300, 1000]
+state_compile_sizes = [5, 50, 100]
+
+def benchmark(size):
+
+    spec = gridworld.gridworld_spec('infinite', size, size)
+
+    start = time.perf_counter()
+    model = compile_gridworld(spec, gridworld.policy)
+    compile_seconds = time.perf_counter() - start
+
+    random_policy = model.policy_probabilities(-np.ones(model.n_states, dtype=np.int64))
+    evaluation = evaluate(model, random_policy, gridworld.discount_factor, "sweep", gridworld.threshold)
+    control = solve(model, gridworld.discount_factor, "value-iteration", gridworld.threshold)
+    prioritized = solve(model, gridworld.discount_factor, "prioritized-sweeping", gridworld.threshold)
+
+    print("{:>5}x{:<5} {:>9} states | compile {:.3f}s | evaluation {} | {} | {}".format(
+        size, size, model.n_states, compile_seconds, evaluation, control, prioritized))
+
+    if size in state_compile_sizes:
+        grid = gridworld.initialize_grid(size-1, size-1)
+
+        def transition(action, state_considered):
+            reward, move_to = spec.transition(state_considered.position, action)
+            return [reward, grid[move_to[0]][move_to[1]]]
+
+        start = time.perf_counter()
+        compile_grid(grid, transition, gridworld.policy)
+        print("{:>11} compile through State objects {:.3f}s".format("", time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    for size in sizes:
+        benchmark(size)
@@ -0,0 +1,292 @@
+import time
+import heapq
+import numpy as np
+
+
+evaluation_modes = ["sweep", "solve", "gmres"]
+solvers = ["policy-iteration", "value-iteration", "modified-policy-iteration", "prioritized-sweeping"]
+
+
+class EvaluationResult():
+    '''Outcome of a policy evaluation: the state values and what it took to get them'''
+
+    def __init__(self, values, mode, iterations, seconds):
+        self.values = values
+        self.mode = mode
+        self.iterations = iterations
+        self.seconds = seconds
+
+    def __str__(self):
+        return "{}: {} iterations in {:.4f} seconds".format(self.mode, self.iterations, self.seconds)
+
+
+class SolverResult():
+    '''Outcome of a control solver: values, greedy policy (action indices), the
+    number of sweeps over all states it took and the number of single-state
+    backups (a sweep backs up every state once)'''
+
+    def __init__(self, values, policy, solver, sweeps, seconds, backups=None):
+        self.values = values
+        self.policy = policy
+        self.solver = solver
+        self.sweeps = sweeps
+        self.seconds = seconds
+        self.backups = sweeps * len(values) if backups is None else backups
+
+    def __str__(self):
+        return "{}: {} sweeps ({} backups) in {:.4f} seconds".format(self.solver, self.sweeps, self.backups, self.seconds)
+
+
+def evaluate(model, policy, discount_factor, mode="sweep", threshold=1e-11, values=None):
+
+    '''Evaluate a (S, A) matrix of action probabilities on a compiled model.
+
+    "sweep" repeats synchronous backups V = R_pi + discount * P_pi V until no value
+    changes by more than threshold; it works for any discount factor and starts
+    from the given values. "solve" solves (I - discount * P_pi) V = R_pi exactly
+    with a dense solver and "gmres" iteratively with a sparse one; both need a
+    discount factor below 1, otherwise the system can be singular. (Backing up
+    single states in order of their Bellman error only pays off for control with
+    sparse rewards, so it is the "prioritized-sweeping" solver and not a mode here.)'''
+
+    if mode not in evaluation_modes:
+        raise ValueError("Unknown evaluation mode: {}".format(mode))
+
+    start = time.perf_counter()
+
+    values = model.initial_values(values)
+
+    if mode == "sweep":
+
+        P_pi, R_pi = model.policy_model(policy)
+        iterations = 0
+
+        while True:
+            updated_values = R_pi + discount_factor * (P_pi @ values)
+            change = np.abs(updated_values - values).max()
+
+            values = updated_values
+            iterations += 1
+
+            if change < threshold:
+                break
+
+    else:
+
+        if discount_factor >= 1:
+            raise ValueError("Mode {} needs a discount factor below 1".format(mode))
+
+        if mode == "solve":
+            P_pi, R_pi = model.policy_model(policy, sparse=False)
+            values = np.linalg.solve(np.eye(model.n_states) - discount_factor * P_pi, R_pi)
+            iterations = 1
+
+        elif mode == "gmres":
+            from scipy import sparse as sp
+            from scipy.sparse.linalg import gmres
+
+            P_pi, R_pi = model.policy_model(policy)
+            system = sp.identity(model.n_states, format="csr") - discount_factor * P_pi
+
+            residuals = []
+            values, info = gmres(system, R_pi, x0=values, rtol=threshold, atol=0,
+                                 callback=residuals.append, callback_type="pr_norm")
+            if info != 0:
+                raise RuntimeError("GMRES did not converge (info {})".format(info))
+
+            iterations = len(residuals)
+
+    return EvaluationResult(values, mode, iterations, time.perf_counter() - start)
+
+
+def improve_policy(model, values, discount_factor, old_policy, threshold=1e-11):
+
+    '''Greedify a policy (action indices, -1 for random) with respect to values.
+    A random policy always becomes greedy; otherwise the action only changes when
+    another one is better by more than threshold, so that equally good actions do
+    not keep replacing each other.'''
+
+    states = np.arange(model.n_states)
+
+    action_values = model.action_values(values, discount_factor)
+    best_action = action_values.argmax(axis=1)
+
+    improved = (old_policy < 0) | (action_values[states, best_action] > action_values[states, old_policy] + threshold)
+
+    return np.where(improved, best_action, old_policy)
+
+
+def value_iteration(model, discount_factor, threshold=1e-11, values=None):
+
+    '''Value iteration: back up the maximum over actions until no value changes by
+    more than threshold, then read off the greedy policy'''
+
+    start = time.perf_counter()
+
+    values = model.initial_values(values)
+
+    sweeps = 0
+
+    while True:
+        updated_values = model.action_values(values, discount_factor).max(axis=1)
+        change = np.abs(updated_values - values).max()
+
+        values = updated_values
+        sweeps += 1
+
+        if change < threshold:
+            break
+
+    policy = model.action_values(values, discount_factor).argmax(axis=1)
+
+    return SolverResult(values, policy, "value-iteration", sweeps, time.perf_counter() - start)
+
+
+def modified_policy_iteration(model, discount_factor, sweeps_per_evaluation=5, threshold=1e-11, values=None):
+
+    '''Modified policy iteration: greedify, then evaluate the greedy policy with only
+    a fixed number of sweeps instead of to convergence. Stops once the Bellman
+    optimality backup changes no value by more than threshold.'''
+
+    start = time.perf_counter()
+
+    values = model.initial_values(values)
+
+    states = np.arange(model.n_states)
+    sweeps = 0
+
+    while True:
+
+        # improvement: one full lookahead, which also gives the optimality residual
+        action_values = model.action_values(values, discount_factor)
+        policy = action_values.argmax(axis=1)
+        sweeps += 1
+
+        if np.abs(action_values[states, policy] - values).max() < threshold:
+            values = action_values[states, policy]
+            break
+
+        # partial evaluation of the greedy policy
+        next_state = model.next_state[states, policy]
+        reward = model.reward[states, policy]
+
+        values = action_values[states, policy]
+        for sweep in range(sweeps_per_evaluation - 1):
+            values = reward + discount_factor * values[next_state]
+            sweeps += 1
+
+    return SolverResult(values, policy, "modified-policy-iteration", sweeps, time.perf_counter() - start)
+
+
+def policy_iteration(model, discount_factor, mode="sweep", threshold=1e-11, values=None, policy=None):
+
+    '''Policy iteration: evaluate the policy fully (see evaluate), greedify and repeat
+    until the policy is stable. Starts from the random policy unless given one.'''
+
+    start = time.perf_counter()
+
+    if policy is None:
+        policy = -np.ones(model.n_states, dtype=np.int64)
+
+    sweeps = 0
+
+    while True:
+        result = evaluate(model, model.policy_probabilities(policy), discount_factor, mode, threshold, values)
+        values = result.values
+        sweeps += result.iterations
+
+        new_policy = improve_policy(model, values, discount_factor, policy, threshold)
+        sweeps += 1
+
+        policy_stable = np.array_equal(new_policy, policy)
+        policy = new_policy
+
+        if policy_stable:
+            break
+
+    return SolverResult(values, policy, "policy-iteration", sweeps, time.perf_counter() - start)
+
+
+def prioritized_backups(model, discount_factor, threshold=1e-11, values=None):
+
+    '''Asynchronous value iteration: back up one state at a time, always the one with
+    the largest Bellman error. After a backup only the predecessors of that state
+    can have a changed error, so only those are re-scored. Returns the values once
+    no Bellman error exceeds threshold, and the number of backups.'''
+
+    values = model.initial_values(values)
+
+    predecessor_states, pointers = model.predecessors()
+
+    # plain lists are much faster than arrays for the single-state updates below
+    next_state = model.next_state.tolist()
+    reward = model.reward.tolist()
+    predecessors = predecessor_states.tolist()
+    pointers = pointers.tolist()
+    value_list = values.tolist()
+
+    def backup(state):
+        return max(r + discount_factor * value_list[s] for r, s in zip(reward[state], next_state[state]))
+
+    # the initial Bellman errors need a full vectorized sweep
+    errors = np.abs(model.action_values(values, discount_factor).max(axis=1) - values)
+
+    priority = errors.tolist()
+    queue = [(-error, state) for state, error in enumerate(priority) if error > threshold]
+    heapq.heapify(queue)
+
+    backups = 0
+
+    while queue:
+        error, state = heapq.heappop(queue)
+
+        # skip entries that were superseded by a later re-scoring
+        if -error != priority[state]:
+            continue
+
+        value_list[state] = backup(state)
+        priority[state] = 0
+        backups += 1
+
+        for predecessor in set(predecessors[pointers[state]:pointers[state+1]]):
+            error = abs(backup(predecessor) - value_list[predecessor])
+
+            if error > threshold:
+                priority[predecessor] = error
+                heapq.heappush(queue, (-error, predecessor))
+            else:
+                priority[predecessor] = 0
+
+    return np.array(value_list), backups
+
+
+def prioritized_sweeping(model, discount_factor, threshold=1e-11, values=None):
+
+    '''Control by prioritized asynchronous value iteration, then read off the greedy policy'''
+
+    start = time.perf_counter()
+
+    values, backups = prioritized_backups(model, discount_factor, threshold, values)
+    policy = model.action_values(values, discount_factor).argmax(axis=1)
+
+    # one vectorized sweep is spent on the initial errors and one on the policy
+    return SolverResult(values, policy, "prioritized-sweeping", 2, time.perf_counter() - start, backups + 2 * model.n_states)
+
+
+def solve(model, discount_factor, solver="policy-iteration", threshold=1e-11, values=None, policy=None,
+          mode="sweep", sweeps_per_evaluation=5):
+
+    '''Find the optimal values and policy with one of the solvers: "policy-iteration"
+    (with the given evaluation mode), "value-iteration", "modified-policy-iteration"
+    (with the given number of evaluation sweeps) or "prioritized-sweeping"'''
+
+    if solver == "policy-iteration":
+        return policy_iteration(model, discount_factor, mode, threshold, values, policy)
+    elif solver == "value-iteration":
+        return value_iteration(model, discount_factor, threshold, values)
+    elif solver == "modified-policy-iteration":
+        return modified_policy_iteration(model, discount_factor, sweeps_per_evaluation, threshold, values)
+    elif solver == "prioritized-sweeping":
+        return prioritized_sweeping(model, discount_factor, threshold, values)
+    else:
+        raise ValueError("Unknown solver: {}".format(solver))
@@ -0,0 +1,258 @@
+import numpy as np
+
+
+# displacement of every action on the grid
+moves = {"N": (-1, 0), "S": (1, 0), "W": (0, -1), "E": (0, 1)}
+
+
+class GridSpec():
+    '''Definition of a gridworld of any size.
+
+    teleports maps a cell to (target cell, reward): every action taken there moves
+    to the target. terminals are absorbing cells that give no further reward.
+    entry_rewards maps a cell to the reward for moving into it. Moving off the grid
+    leaves the agent in place with off_grid_reward; any other move yields
+    step_reward.'''
+
+    def __init__(self, rows, columns, teleports=None, terminals=(), entry_rewards=None,
+                 off_grid_reward=-1, step_reward=0):
+        self.rows = rows
+        self.columns = columns
+        self.teleports = dict(teleports or {})
+        self.terminals = [tuple(cell) for cell in terminals]
+        self.entry_rewards = dict(entry_rewards or {})
+        self.off_grid_reward = off_grid_reward
+        self.step_reward = step_reward
+
+    def transition(self, position, action):
+        '''Reward and next position of taking an action at a single position'''
+
+        position = tuple(position)
+
+        if position in self.teleports:
+            target, reward = self.teleports[position]
+            return [reward, tuple(target)]
+
+        if position in self.terminals:
+            return [0, position]
+
+        move_to = (position[0] + moves[action][0], position[1] + moves[action][1])
+
+        if 0 <= move_to[0] < self.rows and 0 <= move_to[1] < self.columns: # ordinary move
+            return [self.entry_rewards.get(move_to, self.step_reward), move_to]
+
+        return [self.off_grid_reward, position] # move impossible
+
+
+class TabularMDP():
+    '''A deterministic gridworld MDP compiled into arrays: taking action a in
+    state s leads to next_state[s, a] and yields reward[s, a]. States are
+    numbered row by row. terminal marks the absorbing states, whose value is 0.'''
+
+    def __init__(self, next_state, reward, shape, actions, terminal=None):
+        self.next_state = np.asarray(next_state, dtype=np.int64)
+        self.reward = np.asarray(reward, dtype=float)
+        self.shape = shape
+        self.actions = list(actions)
+        self.n_states, self.n_actions = self.next_state.shape
+
+        if terminal is None:
+            terminal = np.zeros(self.n_states, dtype=bool)
+        self.terminal = np.asarray(terminal, dtype=bool)
+
+    def initial_values(self, values=None):
+        '''Starting values for the solvers: zeros, or a copy of the given values with
+        the terminal states pinned to 0 (with a discount factor of 1 any value there
+        would be a fixed point of the backups)'''
+
+        if values is None:
+            return np.zeros(self.n_states)
+
+        return np.where(self.terminal, 0.0, values)
+
+    def transition_matrix(self, sparse=False):
+        '''P[s, a, s'] as a dense (S, A, S) array, or as a sparse (S*A, S) matrix'''
+
+        if sparse:
+            from scipy import sparse as sp
+
+            rows = np.arange(self.n_states * self.n_actions)
+            return sp.csr_matrix((np.ones(len(rows)), (rows, self.next_state.ravel())),
+                                 shape=(self.n_states * self.n_actions, self.n_states))
+
+        P = np.zeros((self.n_states, self.n_actions, self.n_states))
+        states, actions = np.indices(self.next_state.shape)
+        P[states, actions, self.next_state] = 1
+
+        return P
+
+    def policy_probabilities(self, indices):
+        '''(S, A) action probabilities of a policy given as action indices per state,
+        where -1 stands for the random policy'''
+
+        indices = np.asarray(indices)
+        probabilities = np.zeros((self.n_states, self.n_actions))
+
+        probabilities[indices < 0, :] = 1 / self.n_actions
+        probabilities[np.flatnonzero(indices >= 0), indices[indices >= 0]] = 1
+
+        return probabilities
+
+    def policy_model(self, policy, sparse=True):
+        '''Transition matrix P_pi[s, s'] and expected reward R_pi[s] of following a
+        (S, A) matrix of action probabilities'''
+
+        R_pi = (policy * self.reward).sum(axis=1)
+        states = np.repeat(np.arange(self.n_states), self.n_actions)
+
+        if sparse:
+            from scipy import sparse as sp
+
+            # duplicate entries (actions leading to the same state) are summed
+            P_pi = sp.csr_matrix((policy.ravel(), (states, self.next_state.ravel())),
+                                 shape=(self.n_states, self.n_states))
+        else:
+            P_pi = np.zeros((self.n_states, self.n_states))
+            np.add.at(P_pi, (states, self.next_state.ravel()), policy.ravel())
+
+        return P_pi, R_pi
+
+    def predecessors(self):
+        '''Index of the states that can lead to each state, in compressed form: the
+        predecessors of state s are states[pointers[s]:pointers[s+1]]'''
+
+        successors = self.next_state.ravel()
+        order = np.argsort(successors, kind="stable")
+
+        states = order // self.n_actions
+        pointers = np.concatenate([[0], np.cumsum(np.bincount(successors, minlength=self.n_states))])
+
+        return states, pointers
+
+    def action_values(self, values, discount_factor):
+        '''One-step lookahead: the value of every state-action given state values'''
+        return self.reward + discount_factor * values[self.next_state]
+
+    def backup(self, values, policy, discount_factor):
+        '''Expected one-step lookahead under a (S, A) matrix of action probabilities'''
+        return (policy * self.action_values(values, discount_factor)).sum(axis=1)
+
+
+def compile_gridworld(spec, actions):
+
+    '''Compile a GridSpec into a TabularMDP directly with array operations, without
+    visiting the states one by one; special cells are patched in afterwards'''
+
+    n_states = spec.rows * spec.columns
+    rows, columns = np.divmod(np.arange(n_states), spec.columns)
+
+    next_state = np.empty((n_states, len(actions)), dtype=np.int64)
+    reward = np.empty((n_states, len(actions)))
+    moved = np.empty((n_states, len(actions)), dtype=bool)
+
+    for a, action in enumerate(actions):
+        move_to_row = rows + moves[action][0]
+        move_to_column = columns + moves[action][1]
+
+        moved[:, a] = (move_to_row >= 0) & (move_to_row < spec.rows) & (move_to_column >= 0) & (move_to_column < spec.columns)
+
+        next_state[:, a] = np.where(moved[:, a], move_to_row * spec.columns + move_to_column, np.arange(n_states))
+        reward[:, a] = np.where(moved[:, a], spec.step_reward, spec.off_grid_reward)
+
+    # moving into a rewarding cell (bumping into the edge there is not rewarded)
+    for cell, cell_reward in spec.entry_rewards.items():
+        cell_state = cell[0] * spec.columns + cell[1]
+        reward[moved & (next_state == cell_state)] = cell_reward
+
+    terminal = np.zeros(n_states, dtype=bool)
+
+    for cell in spec.terminals:
+        cell_state = cell[0] * spec.columns + cell[1]
+        next_state[cell_state, :] = cell_state
+        reward[cell_state, :] = 0
+        terminal[cell_state] = True
+
+    for cell, (target, cell_reward) in spec.teleports.items():
+        cell_state = cell[0] * spec.columns + cell[1]
+        next_state[cell_state, :] = target[0] * spec.columns + target[1]
+        reward[cell_state, :] = cell_reward
+        terminal[cell_state] = False
+
+    return TabularMDP(next_state, reward, (spec.rows, spec.columns), actions, terminal)
+
+
+def compile_grid(grid, transition, actions):
+
+    '''Compile a grid of states into a TabularMDP, calling transition(action, state)
+    (which returns [reward, new_state]) exactly once for every state-action'''
+
+    rows, columns = len(grid), len(grid[0])
+
+    next_state = np.zeros((rows * columns, len(actions)), dtype=np.int64)
+    reward = np.zeros((rows * columns, len(actions)))
+
+    for row in range(rows):
+        for column in range(columns):
+
+            state = row * columns + column
+
+            for a, action in enumerate(actions):
+                outcome = transition(action, grid[row][column])
+
+                reward[state, a] = outcome[0]
+                next_state[state, a] = outcome[1].position[0] * columns + outcome[1].position[1]
+
+    return TabularMDP(next_state, reward, (rows, columns), actions)
+
+
+def policy_matrix(grid, actions):
+
+    '''Turn the policies stored in the grid into a (S, A) matrix of action
+    probabilities: "random" spreads evenly over all actions, otherwise the
+    stored action is taken with certainty'''
+
+    policies = [state.policy for grid_row in grid for state in grid_row]
+    matrix = np.zeros((len(policies), len(actions)))
+
+    for state, policy in enumerate(policies):
+        if policy == "random":
+            matrix[state, :] = 1 / len(actions)
+        else:
+            matrix[state, actions.index(policy)] = 1
+
+    return matrix
+
+
+def grid_values(grid):
+
+    '''The values stored in the grid as one array of state values'''
+
+    return np.array([state.value for grid_row in grid for state in grid_row], dtype=float)
+
+
+def store_values(grid, values):
+
+    '''Write an array of state values back into the grid'''
+
+    columns = len(grid[0])
+
+    for state, value in enumerate(values):
+        grid[state // columns][state % columns].value = value
+
+
+def policy_indices(grid, actions):
+
+    '''The policies stored in the grid as action indices, -1 for "random"'''
+
+    return np.array([-1 if state.policy == "random" else actions.index(state.policy)
+                     for grid_row in grid for state in grid_row], dtype=np.int64)
+
+
+def store_policies(grid, indices, actions):
+
+    '''Write an array of action indices back into the grid as policies'''
+
+    columns = len(grid[0])
+
+    for state, index in enumerate(indices):
+        grid[state // columns][state % columns].policy = "random" if index < 0 else actions[index]
@@ -6,11 +6,11 @@
 #
 
 import numpy as np
-import random
-import math
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
+from tabular import GridEnvironment, QTable, RandomStream, EpsilonGreedy, exploration_epsilon, curve_statistics, run_kernel_episodes, kernel_backend, run_td_learner, ResultStore, run_batched_td
 
 # Specify grid size
 grid_columns = 9
@@ -28,72 +28,51 @@ threshold = 0.00000000001
 actions = ["N", "E", "W", "S"]
 episodes = 1000
 
-grid = []
+# Transitions and rewards of the layout, compiled once
+environment = GridEnvironment(grid_rows+1, grid_columns+1, actions, terminals=cliff + [goal],
+                              entry_rewards=dict([(cell, -100) for cell in cliff] + [(goal, 10)]))
 
-class State():
+grid = None
 
-    '''Defines a state in the grid'''
 
-    def __init__(self, row, column, start=False, goal=False, cliff=False):
-        self.position = [row, column]
-        self.actions = []
-        self.cliff = cliff
-        self.start = start
-        self.goal = goal
-        self.optimal_action = "undefined"
+def initialize_grid(grid_rows, grid_columns, rng=None):
 
-        if cliff or goal:
-            self.actions.append(Action(self.position,"X"))
+    '''Initialize a Q-table for the cliffwalking game, including cliff and goal state'''
 
-        else:
-            for action in actions:
-                self.actions.append(Action(self.position, action))
+    if rng is None:
+        rng = np.random.default_rng()
 
-    def __str__(self):
-        return self.position
+    grid = QTable(grid_rows+1, grid_columns+1, actions, terminals=cliff + [goal])
 
+    # action values start out random (in row-major order, cliff and goal have a single "X" action)
+    grid.values[grid.valid] = rng.uniform(0, 1, grid.n_valid.sum())
 
-class Action():
-
-    '''Defines an action that is attached to a state'''
-
-    def __init__(self, position, direction):
-        self.position = position
-        self.direction = direction
-        self.value = random.uniform(0, 1)
-
-    def __str__(self):
-        return str(self.value)
-
-
-def initialize_grid(grid_rows, grid_columns):
-
-    '''Initialize a grid for the cliffwalking game, including cliff and goal state'''
-
-    grid = []
+    return grid
 
-    for row in range(grid_rows+1):
-        grid_row = []
 
-        for column in range(grid_columns+1):
+def perform_sarsa(epsilon, rng=None, backend="python", exploration=None, monitor=None):
 
-            if (row, column) in cliff:
-                grid_row.append(State(row, column, cliff=True))
-            elif (row, column) == goal:
-                grid_row.append(State(row, column, goal=True))
-            elif (row, column) == start:
-                grid_row.append(State(row, column, start=True))
-            else:
-                grid_row.append(State(row, column))
+    '''Performs SARSA (on-policy TD) to estimate optimal state-action value'''
 
-        grid.append(grid_row)
+    stream = RandomStream(rng)
 
-    return grid
+    if kernel_backend(backend) == "numba":
+        # the compiled episode kernels of tabular on the same Q array and draws
+        return run_kernel_episodes(environment, grid.q, "sarsa", episodes, alpha, discount_factor,
+                                   exploration_epsilon(exploration, epsilon), lambda stream: environment.state_id(start),
+                                   stream, monitor)
 
+    # precompiled environment: a step is two table lookups
+    next_states, rewards, terminal = environment.next_state_list, environment.reward_list, environment.terminal_list
+    q = grid.q
+    n_valid = grid.n_valid_list
 
-def perform_sarsa(epsilon):
+    if exploration is None:
+        exploration = EpsilonGreedy(epsilon)
+    exploration.reset(environment.n_states, environment.n_actions)
 
-    '''Performs SARSA (on-policy TD) to estimate optimal state-action value'''
+    if monitor is not None:
+        monitor.start()
 
     time = 1
 
@@ -104,10 +83,10 @@ def perform_sarsa(epsilon):
     while time < episodes:
 
         # select the starting state
-        state = grid[start[0]][start[1]]
+        state = environment.state_id(start)
 
-        # select an initial action following an epsilon greedy policy
-        action = epsilon_greedy(state, epsilon)
+        # select an initial action following the exploration policy
+        action = exploration.action(q, state, n_valid[state], time, stream)
 
         # performance statistics
         change_in_episode = 0
@@ -115,26 +94,24 @@ def perform_sarsa(epsilon):
         reward_sum = 0
 
         # follow policy until treasure is found or snakepit is reached
-        while not state.cliff and not state.goal:
-
-            # follow the defined action
-            moved = move(state, action)
+        while not terminal[state]:
 
-            # observe reward and next state
-            next_state = moved[0]
-            reward = moved[1]
+            # follow the defined action and observe reward and next state
+            next_state = next_states[state][action]
+            reward = rewards[state][action]
 
             reward_sum += reward
 
-            # choose new action in new state following an epsilon-greedy policy
-            next_action = epsilon_greedy(next_state, epsilon)
+            # choose new action in new state following the exploration policy
+            next_action = exploration.action(q, next_state, n_valid[next_state], time, stream)
 
             # update the Q-value of the state-action
-            old_value = action.value
-            action.value = action.value + alpha * (reward + discount_factor * next_action.value - action.value)
+            old_value = q[state, action]
+            new_value = old_value + alpha * (reward + discount_factor * q[next_state, next_action] - old_value)
+            q[state, action] = new_value
 
             # record performance statistics
-            update_size = abs(action.value - old_value)
+            update_size = abs(new_value - old_value)
             change_in_episode += update_size
 
             # move on to the next state and action (on-policy)
@@ -143,15 +120,43 @@ def perform_sarsa(epsilon):
 
         change_per_episode_sarsa.append(change_in_episode)
         reward_per_episode_sarsa.append(reward_sum)
+
+        # stop once the monitor sees convergence
+        if monitor is not None and monitor.update(change_in_episode, q, environment.valid):
+            break
+
         time += 1
 
+    if monitor is not None:
+        monitor.finish()
+
     return(change_per_episode_sarsa, reward_per_episode_sarsa)
 
 
-def perform_qlearning(epsilon):
+def perform_qlearning(epsilon, rng=None, backend="python", exploration=None, monitor=None):
 
     ''' Performs Q-learning (off-policy TD) to estimate optimal state-action value'''
 
+    stream = RandomStream(rng)
+
+    if kernel_backend(backend) == "numba":
+        # the compiled episode kernels of tabular on the same Q array and draws
+        return run_kernel_episodes(environment, grid.q, "qlearning", episodes, alpha, discount_factor,
+                                   exploration_epsilon(exploration, epsilon), lambda stream: environment.state_id(start),
+                                   stream, monitor)
+
+    # precompiled environment: a step is two table lookups
+    next_states, rewards, terminal = environment.next_state_list, environment.reward_list, environment.terminal_list
+    q = grid.q
+    n_valid = grid.n_valid_list
+
+    if exploration is None:
+        exploration = EpsilonGreedy(epsilon)
+    exploration.reset(environment.n_states, environment.n_actions)
+
+    if monitor is not None:
+        monitor.start()
+
     time = 1
 
     # performance statistics
@@ -161,34 +166,34 @@ def perform_qlearning(epsilon):
     while time < episodes:
 
         # select the starting state
-        state = grid[start[0]][start[1]]
+        state = environment.state_id(start)
 
         # performance statistics
         change_in_episode = 0
 
         reward_sum = 0
 
-        while not state.cliff and not state.goal:
+        while not terminal[state]:
 
-            # select action following an epsilon greedy policy
-            action = epsilon_greedy(state, epsilon)
+            # select action following the exploration policy
+            action = exploration.action(q, state, n_valid[state], time, stream)
 
             # follow defined action and observe reward and next state
-            moved = move(state, action)
-            next_state = moved[0]
-            reward = moved[1]
+            next_state = next_states[state][action]
+            reward = rewards[state][action]
 
             reward_sum += reward
 
-            # define the exploitative action in the next state
-            exploitative_action = exploitative_policy(next_state)
+            # define the value of the exploitative action in the next state
+            exploitative_value = grid.max_value(next_state)
 
             # update Q-value of the state-action
-            old_value = action.value
-            action.value = action.value + alpha * (reward + discount_factor * exploitative_action.value - action.value)
+            old_value = q[state, action]
+            new_value = old_value + alpha * (reward + discount_factor * exploitative_value - old_value)
+            q[state, action] = new_value
 
             # record performance statistics
-            update_size = abs(action.value - old_value)
+            update_size = abs(new_value - old_value)
             change_in_episode += update_size
 
             # move on to the next state
@@ -196,46 +201,38 @@ def perform_qlearning(epsilon):
 
         change_per_episode_qlearning.append(change_in_episode)
         reward_per_episode_qlearning.append(reward_sum)
-        time +=1
 
-    return(change_per_episode_qlearning, reward_per_episode_qlearning)
+        # stop once the monitor sees convergence
+        if monitor is not None and monitor.update(change_in_episode, q, environment.valid):
+            break
 
+        time +=1
 
+    if monitor is not None:
+        monitor.finish()
+
+    return(change_per_episode_qlearning, reward_per_episode_qlearning)
 
-def move(state, action):
 
-    '''Following an action in a state, returns consecutive state and received reward'''
 
-    # calculate the new aimed-for position
-    if action.direction == "N":
-        move_to = np.add(state.position, [-1, 0])
-    elif action.direction == "S":
-        move_to = np.add(state.position, [1, 0])
-    elif action.direction == "W":
-        move_to = np.add(state.position, [0, -1])
-    elif action.direction == "E":
-        move_to = np.add(state.position, [0, 1])
+def perform_learner(algorithm, epsilon, rng=None, exploration=None, **parameters):
 
+    '''Performs one of the learners of tabular.td_learners (Expected SARSA, n-step SARSA,
+    SARSA(lambda), Watkins's Q(lambda), Dyna-Q or Dyna-Q+); parameters such as n_steps,
+    trace_decay or planning_steps are passed on to tabular.run_td_learner'''
 
-    # we must stay within the grid, else stay in current position
-    if move_to[0] > grid_rows or move_to[0] < 0 \
-        or move_to[1] > grid_columns or move_to[1] < 0:
+    if exploration is None:
+        exploration = EpsilonGreedy(epsilon)
 
-        next_state = state
-        reward = -1
+    return run_td_learner(environment, grid.q, algorithm, episodes, alpha, discount_factor, exploration,
+                          lambda stream: environment.state_id(start), RandomStream(rng), **parameters)
 
-    else:
 
-        next_state = grid[move_to[0]][move_to[1]]
+def move(state, action):
 
-        if next_state.cliff:
-            reward = -100
-        elif next_state.goal:
-            reward = 10
-        else:
-            reward = -1
+    '''Following an action in a state (both ids), returns consecutive state and received reward'''
 
-    return (next_state, reward)
+    return environment.step(state, action)
 
 
 
@@ -243,36 +240,16 @@ def exploitative_policy(state):
 
     '''Find the exploitative action in a state (ie state with higest value)'''
 
-    # initialize to arbitrarily low value
-    current_high = -math.inf
-
-    # consider all state-actions and choose action with highest value
-    for action in state.actions:
-        if action.value > current_high:
-            current_high = action.value
-            optimal_action = action
-
-    return optimal_action
-
+    return grid.greedy_action(state)
 
 
-def epsilon_greedy(state, epsilon):
 
-    '''A GLIE version of epsilon-greedy policy selection. The probability to select
-    a random action rather than a greedy one decreases over time.'''
+def epsilon_greedy(state, epsilon, stream):
 
-    # follow a GLIE policy: 1 / timesteps
-    pol_choice = random.uniform(0, 1)
+    '''Epsilon-greedy policy selection with a fixed probability to select a random
+    action rather than a greedy one (see tabular.EpsilonGreedy)'''
 
-    # below threshold choose the explorative (random) action
-    if pol_choice < epsilon:
-        action = random.choice(state.actions)
-
-    # above threshold choose an exploitative (maximizing) action
-    else:
-        action = exploitative_policy(state)
-
-    return action
+    return EpsilonGreedy(epsilon).action(grid.q, state, grid.n_valid_list[state], 1, stream)
 
 
 
@@ -280,19 +257,11 @@ def extract_optimal_policy():
 
     '''For all states, select the action with the highest Q-value as the optimal one.'''
 
-    # consider all states in the grid
-    for row in range(grid_rows+1):
-        for column in range(grid_columns+1):
-
-            state = grid[row][column]
+    best_actions = grid.masked_values().argmax(axis=2)
 
-            # consider all actions and save that with highest value
-            optimal_value = -math.inf
-
-            for action in state.actions:
-                if action.value > optimal_value:
-                    optimal_value = action.value
-                    state.optimal_action = action.direction
+    for row in range(grid.rows):
+        for column in range(grid.columns):
+            grid.optimal_action[row, column] = grid.direction(environment.state_id((row, column)), best_actions[row, column])
 
 
 
@@ -302,7 +271,7 @@ def print_grid(grid):
 
     for row in range(grid_rows+1):
         for column in range(grid_columns+1):
-            print(grid[row][column].optimal_action, end = '')
+            print(grid.optimal_action[row, column], end = '')
             print(" | ", end = '')
         print("")
 
@@ -315,29 +284,27 @@ def print_SA_values():
     for row in range(grid_rows+1):
         for column in range(grid_columns+1):
 
-            state = grid[row][column]
+            print("State at position " + str([row, column]) + ":")
 
-            print("State at position " + str(state.position) + ":")
+            state = environment.state_id((row, column))
 
-            for action in state.actions:
-                print(action.direction + ": " + "%.2f" % action.value)
+            for action in range(grid.n_valid_list[state]):
+                print(grid.direction(state, action) + ": " + "%.2f" % grid.q[state, action])
 
             print()
 
-def plot_results(results, index, num_plots, plot_rewards=True, title=None, label="run", final_plot=False):
-    #change_smoothed_sarsa = pd.Series(reward_per_episode_sarsa).rolling(smoothing_window, min_periods=smoothing_window).mean()
+def plot_results(results, index, num_plots, plot_rewards=True, title=None, label="run", final_plot=False, band=None):
 
-    num = len(results)
+    '''Plot the mean curve of an experiment from its [change, rewards] pair of
+    CurveStatistics. band can add a shaded area: "std" for one standard deviation
+    around the mean, or a (low, high) pair of quantiles (needs a sample_size).'''
 
-    if plot_rewards:
-        results = [results[i][1] for i in range(num)]
-    else:
-        results = [results[i][0] for i in range(num)]
+    #change_smoothed_sarsa = pd.Series(reward_per_episode_sarsa).rolling(smoothing_window, min_periods=smoothing_window).mean()
 
-    mean = [np.mean([results[j][i] for j in range(num)]) for i in range(episodes-1)]
-    std = [np.std([results[j][i] for j in range(num)]) for i in range(episodes-1)]
+    statistics = results[1] if plot_rewards else results[0]
 
-    epochs = list(range(episodes-1))
+    mean = statistics.mean
+    epochs = np.arange(len(mean))
 
     clrs = sns.color_palette("muted", num_plots)
 
@@ -351,7 +318,11 @@ def plot_results(results, index, num_plots, plot_rewards=True, title=None, label
 
 
     plt.plot(epochs, mean, label=label, c=clrs[index])
-    #plt.fill_between(epochs, [mean[i]-std[i] for i in range(episodes-1)], [mean[i]+std[i] for i in range(episodes-1)], alpha=0.3, facecolor=clrs[index])
+    if band == "std":
+        plt.fill_between(epochs, mean - statistics.std(), mean + statistics.std(), alpha=0.3, facecolor=clrs[index])
+    elif band is not None:
+        low, high = statistics.quantile(band)
+        plt.fill_between(epochs, low, high, alpha=0.3, facecolor=clrs[index])
 
     if final_plot:
          plt.legend()
@@ -359,18 +330,9 @@ def plot_results(results, index, num_plots, plot_rewards=True, title=None, label
 
 def plot_grid():
 
-    results = np.ones(shape=(grid_rows+1, grid_columns+1)) * -math.inf
-    # consider all states in the grid
-
-    for row in range(grid_rows+1):
-        for column in range(grid_columns+1):
-            state = grid[row][column]
-
-            for action in state.actions:
-                results[row][column] = max(action.value, results[row][column])
-
-            if state.cliff or state.goal:
-                results[row][column] = np.nan
+    # the value of the best action in every state
+    results = grid.masked_values().max(axis=2)
+    results[grid.terminal] = np.nan
 
     fig, ax = plt.subplots()
     im = ax.imshow(results)
@@ -381,61 +343,214 @@ def plot_grid():
     fig.tight_layout()
     plt.show()
 
-def run_experiment_sarsa(n=10, epsilon=0.05):
+def run_experiment_sarsa(n=10, epsilon=0.05, rng=None, batched=True, sample_size=0, backend="python",
+                         exploration=None, monitor=None):
     global grid
 
-    results = []
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if batched and monitor is not None:
+        raise ValueError("Replicas train in lockstep when batched: use batched=False to stop them early")
+
+    if batched and backend != "python":
+        raise ValueError("Batched replicas train with the NumPy lockstep engine: use batched=False for the {} backend"
+                         .format(backend))
+
+    if batched:
+        return run_batched_experiment("sarsa", n, exploration_epsilon(exploration, epsilon), rng, sample_size)
+
+    results = curve_statistics(episodes-1, sample_size, rng)
     for i in range(n):
-        grid = initialize_grid(grid_rows, grid_columns)
-        change, rewards = perform_sarsa(epsilon=epsilon)
+        grid = initialize_grid(grid_rows, grid_columns, rng)
+        change, rewards = perform_sarsa(epsilon=epsilon, rng=rng, backend=backend, exploration=exploration,
+                                        monitor=monitor)
         extract_optimal_policy()
-        results += [[change, rewards]]
+        results[0].add(change)
+        results[1].add(rewards)
 
     print_grid(grid)
     print()
+    if monitor is not None:
+        print(monitor.summary())
     return results
 
-def run_experiment_qlearning(n=10, epsilon=0.05):
+def run_experiment_qlearning(n=10, epsilon=0.05, rng=None, batched=True, sample_size=0, backend="python",
+                             exploration=None, monitor=None):
     global grid
 
-    results = []
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if batched and monitor is not None:
+        raise ValueError("Replicas train in lockstep when batched: use batched=False to stop them early")
+
+    if batched and backend != "python":
+        raise ValueError("Batched replicas train with the NumPy lockstep engine: use batched=False for the {} backend"
+                         .format(backend))
+
+    if batched:
+        return run_batched_experiment("qlearning", n, exploration_epsilon(exploration, epsilon), rng, sample_size)
+
+    results = curve_statistics(episodes-1, sample_size, rng)
     for i in range(n):
-        grid = initialize_grid(grid_rows, grid_columns)
-        change, rewards = perform_qlearning(epsilon=epsilon)
+        grid = initialize_grid(grid_rows, grid_columns, rng)
+        change, rewards = perform_qlearning(epsilon=epsilon, rng=rng, backend=backend, exploration=exploration,
+                                            monitor=monitor)
         extract_optimal_policy()
-        results += [[change, rewards]]
+        results[0].add(change)
+        results[1].add(rewards)
 
     print_grid(grid)
     print()
+    if monitor is not None:
+        print(monitor.summary())
     return results
 
+def train_replicas(algorithm, n, epsilon, rng):
+
+    '''Train n replicas of an algorithm in lockstep (see tabular.run_batched_td)'''
+
+    # action values start out random, independently per replica
+    initial_values = np.zeros((n, environment.n_states, environment.n_actions))
+    initial_values[:, environment.valid] = rng.uniform(0, 1, (n, environment.valid.sum()))
+
+    return run_batched_td(environment, algorithm, n, episodes, alpha, discount_factor,
+                          epsilon, environment.state_id(start), initial_values, rng)
+
+
+def show_replica(q):
+
+    '''Load the Q-values of one replica into the grid and print its policy'''
+
+    global grid
+
+    grid = initialize_grid(grid_rows, grid_columns)
+    grid.q[:] = q
+    extract_optimal_policy()
+
+    print_grid(grid)
+    print()
+
+
+def run_experiment_learner(algorithm, n=10, epsilon=0.05, rng=None, sample_size=0, exploration=None, monitor=None,
+                           **parameters):
+    global grid
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    results = curve_statistics(episodes-1, sample_size, rng)
+    for i in range(n):
+        grid = initialize_grid(grid_rows, grid_columns, rng)
+        change, rewards = perform_learner(algorithm, epsilon, rng, exploration, monitor=monitor, **parameters)
+        extract_optimal_policy()
+        results[0].add(change)
+        results[1].add(rewards)
+
+    print_grid(grid)
+    print()
+    if monitor is not None:
+        print(monitor.summary())
+    return results
+
+def run_batched_experiment(algorithm, n, epsilon, rng, sample_size=0, chunk_size=250):
+
+    '''Train n replicas in chunks, folding the curves of every chunk into the statistics'''
+
+    results = curve_statistics(episodes-1, sample_size, rng)
+
+    for chunk_start in range(0, n, chunk_size):
+        q, change, rewards = train_replicas(algorithm, min(chunk_size, n-chunk_start), epsilon, rng)
+        results[0].add_batch(change)
+        results[1].add_batch(rewards)
+
+    # show the policy of the last replica, like the serial experiments do
+    show_replica(q[-1])
+
+    return results
+
+
+def run_job(directory, algorithm, epsilon, start, stop, seed):
+
+    '''Worker for sweep(): train one chunk of replicas and write it to the store'''
+
+    q, change, rewards = train_replicas(algorithm, stop-start, epsilon, np.random.default_rng(seed))
+    ResultStore(directory).write(algorithm, epsilon, start, change=change, rewards=rewards, q=q)
+
+
+def sweep(store, algorithms, epsilons, runs, chunk_size=250, seed=None, workers=None):
+
+    '''Run every (algorithm, epsilon) experiment with the given number of runs on a
+    process pool, in chunks of replicas that are streamed into the ResultStore.
+    Every chunk gets an independent child of one SeedSequence, so a sweep with a
+    fixed seed gives the same results regardless of the number of workers.
+    Chunks that are already in the store are not computed again, unless the seed
+    or the learning parameters changed.'''
+
+    jobs = [(algorithm, epsilon, start, min(start+chunk_size, runs))
+            for algorithm in algorithms for epsilon in epsilons for start in range(0, runs, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(jobs))
+
+    for algorithm in algorithms:
+        for epsilon in epsilons:
+            store.create(algorithm, epsilon, runs, episodes, environment.n_states, environment.n_actions,
+                         {"seed": seed, "alpha": alpha, "discount_factor": discount_factor})
+
+    todo = [(job, job_seed) for job, job_seed in zip(jobs, seeds) if not store.done(*job)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_job, store.directory, *job, job_seed) for job, job_seed in todo]
+        for future in futures:
+            future.result()
+
+
+def read_statistics(store, algorithm, epsilon, sample_size=0, chunk_size=250):
+
+    '''Statistics of an experiment in the store, read chunk by chunk'''
+
+    results = curve_statistics(episodes-1, sample_size)
+    change, rewards = store.read(algorithm, epsilon, "change"), store.read(algorithm, epsilon, "rewards")
+
+    for chunk_start in range(0, len(rewards), chunk_size):
+        results[0].add_batch(change[chunk_start:chunk_start+chunk_size])
+        results[1].add_batch(rewards[chunk_start:chunk_start+chunk_size])
+
+    return results
+
+
+def plot_store(store, algorithms, epsilons):
+
+    '''Redraw the policies and curves of a sweep from the store, without recomputing'''
+
+    names = {"sarsa": "SARSA", "qlearning": "Q-learning"}
+    experiments = [(algorithm, epsilon) for algorithm in algorithms for epsilon in epsilons]
+
+    # policy and values of the last replica at the largest epsilon
+    for algorithm in algorithms:
+        show_replica(store.read(algorithm, max(epsilons), "q")[-1])
+        plot_grid()
+
+    statistics = [read_statistics(store, algorithm, epsilon) for algorithm, epsilon in experiments]
+
+    for plot_rewards, title in ((True, "Sum of rewards per episode"), (False, "Sum of loss per episode")):
+        for index, (algorithm, epsilon) in enumerate(experiments):
+            plot_results(statistics[index], index, len(experiments), plot_rewards=plot_rewards,
+                         title=title if index == 0 else None,
+                         label="{} $\\epsilon$={}".format(names[algorithm], epsilon),
+                         final_plot=index == len(experiments)-1)
+
 
 if __name__ == '__main__':
-    ''' Perform both algorithms consecutively and plot their convergence speed'''
+    ''' Perform both algorithms for several epsilons on all cores and plot their convergence speed.
+    The results are kept in a store on disk: running again only redraws the plots.'''
 
     runs = 1000
 
-    results_sarsa1 = run_experiment_sarsa(n=runs, epsilon=0.1)
-    plot_grid()
-    results_qlearning1 = run_experiment_qlearning(n=runs, epsilon=0.1)
-    plot_grid()
-
-    results_sarsa05 = run_experiment_sarsa(n=runs, epsilon=0.05)
-    results_qlearning05 = run_experiment_qlearning(n=runs, epsilon=0.05)
-
-    results_sarsa01 = run_experiment_sarsa(n=runs, epsilon=0.01)
-    results_qlearning01 = run_experiment_qlearning(n=runs, epsilon=0.01)
-
-    plot_results(results_sarsa1, 0, 6, title="Sum of rewards per episode", label="SARSA $\epsilon$=0.1")
-    plot_results(results_sarsa01, 1, 6, label="SARSA $\epsilon$=0.01")
-    plot_results(results_sarsa05, 2, 6, label="SARSA $\epsilon$=0.05")
-    plot_results(results_qlearning1, 3, 6, label="Q-learning $\epsilon$=0.1")
-    plot_results(results_qlearning01, 4, 6, label="Q-learning $\epsilon$=0.01")
-    plot_results(results_qlearning05, 5, 6, label="Q-learning $\epsilon$=0.05", final_plot=True)
-
-    plot_results(results_sarsa1, 0, 6, plot_rewards=False, title="Sum of loss per episode", label="SARSA $\epsilon$=0.1")
-    plot_results(results_sarsa01, 1, 6, plot_rewards=False, label="SARSA $\epsilon$=0.01")
-    plot_results(results_sarsa05, 2, 6, plot_rewards=False, label="SARSA $\epsilon$=0.05")
-    plot_results(results_qlearning1, 3, 6, plot_rewards=False, label="Q-learning $\epsilon$=0.1")
-    plot_results(results_qlearning01, 4, 6, plot_rewards=False, label="Q-learning $\epsilon$=0.01")
-    plot_results(results_qlearning05, 5, 6, plot_rewards=False, label="Q-learning $\epsilon$=0.05", final_plot=True)
+    algorithms = ["sarsa", "qlearning"]
+    epsilons = [0.1, 0.05, 0.01]
+
+    store = ResultStore("cliffwalking_results")
+
+    sweep(store, algorithms, epsilons, runs)
+    plot_store(store, algorithms, epsilons)
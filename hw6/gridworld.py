@@ -6,12 +6,11 @@
 #
 
 import numpy as np
-import random
-import math
 import matplotlib
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
+from tabular import GridEnvironment, QTable, RandomStream, EpsilonGreedy, exploration_epsilon, inverse_time, curve_statistics, run_kernel_episodes, kernel_backend, run_td_learner, run_batched_td
 
 # Specify grid size
 grid_columns = 7
@@ -29,75 +28,56 @@ threshold = 0.00000000001
 actions = ["N", "E", "W", "S"]
 episodes = 1000
 
-grid = []
+# Transitions and rewards of the layout, compiled once
+environment = GridEnvironment(grid_rows+1, grid_columns+1, actions, walls=walls, terminals=[snakepit, treasure],
+                              entry_rewards={snakepit: -20, treasure: 10})
 
-class State():
+grid = None
 
-    '''Defines a state in the grid'''
 
-    def __init__(self, row, column, wall=False, snakepit=False, treasure=False):
-        self.position = [row, column]
-        self.actions = []
-        self.wall = wall
-        self.snakepit = snakepit
-        self.treasure = treasure
-        self.optimal_action = "undefined"
 
-        if wall or snakepit or treasure:
-            self.actions.append(Action(self.position,"X"))
-
-        else:
-            for action in actions:
-                self.actions.append(Action(self.position, action))
-
-    def __str__(self):
-        return self.position
-
-
-
-class Action():
+def initialize_grid(grid_rows, grid_columns):
 
-    '''Defines an action that is attached to a state'''
+    '''Initialize a Q-table for the gridworld game, including snakepit and treasure'''
 
-    def __init__(self, position, direction):
-        self.position = position
-        self.direction = direction
-        self.value = 0
+    return QTable(grid_rows+1, grid_columns+1, actions, walls=walls, terminals=[snakepit, treasure])
 
-    def __str__(self):
-        return str(self.value)
 
 
+def random_start(stream):
 
-def initialize_grid(grid_rows, grid_columns):
+    '''Select a random starting state (that is not inside a wall!)'''
 
-    '''Initialize a grid for the gridworld game, including snakepit and treasure'''
+    position = (int(stream.uniform() * grid.rows), int(stream.uniform() * grid.columns))
+    while grid.wall[position]:
+        position = (int(stream.uniform() * grid.rows), int(stream.uniform() * grid.columns))
 
-    grid = []
+    return environment.state_id(position)
 
-    for row in range(grid_rows+1):
-        grid_row = []
 
-        for column in range(grid_columns+1):
 
-            if (row, column) in walls:
-                grid_row.append(State(row, column, wall=True))
-            elif (row, column) == snakepit:
-                grid_row.append(State(row, column, snakepit=True))
-            elif (row, column) == treasure:
-                grid_row.append(State(row, column, treasure=True))
-            else:
-                grid_row.append(State(row, column))
+def perform_sarsa(rng=None, backend="python", exploration=None, monitor=None):
 
-        grid.append(grid_row)
+    '''Performs SARSA (on-policy TD) to estimate optimal state-action value'''
 
-    return grid
+    stream = RandomStream(rng)
 
+    if kernel_backend(backend) == "numba":
+        # the compiled episode kernels of tabular on the same Q array and draws
+        return run_kernel_episodes(environment, grid.q, "sarsa", episodes, alpha, discount_factor,
+                                   exploration_epsilon(exploration, inverse_time), random_start, stream, monitor)
 
+    # precompiled environment: a step is two table lookups
+    next_states, rewards, terminal = environment.next_state_list, environment.reward_list, environment.terminal_list
+    q = grid.q
+    n_valid = grid.n_valid_list
 
-def perform_sarsa():
+    if exploration is None:
+        exploration = EpsilonGreedy(inverse_time)
+    exploration.reset(environment.n_states, environment.n_actions)
 
-    '''Performs SARSA (on-policy TD) to estimate optimal state-action value'''
+    if monitor is not None:
+        monitor.start()
 
     time = 1
 
@@ -108,38 +88,34 @@ def perform_sarsa():
     while time < episodes:
 
         # select a random starting state (that is not inside a wall!)
-        state = random.choice(random.choice(grid))
-        while state.wall:
-            state = random.choice(random.choice(grid))
+        state = random_start(stream)
 
-        # select an initial action following an epsilon greedy policy
-        action = epsilon_greedy(state, time)
+        # select an initial action following the exploration policy
+        action = exploration.action(q, state, n_valid[state], time, stream)
 
         # performance statistics
         change_in_episode = 0
         reward_sum = 0
 
         # follow policy until treasure is found or snakepit is reached
-        while not state.treasure and not state.snakepit:
-
-            # follow the defined action
-            moved = move(state, action)
+        while not terminal[state]:
 
-            # observe reward and next state
-            next_state = moved[0]
-            reward = moved[1]
+            # follow the defined action and observe reward and next state
+            next_state = next_states[state][action]
+            reward = rewards[state][action]
 
             reward_sum += reward
 
-            # choose new action in new state following an epsilon-greedy policy
-            next_action = epsilon_greedy(next_state, time)
+            # choose new action in new state following the exploration policy
+            next_action = exploration.action(q, next_state, n_valid[next_state], time, stream)
 
             # update the Q-value of the state-action
-            old_value = action.value
-            action.value = action.value + alpha * (reward + discount_factor * next_action.value - action.value)
+            old_value = q[state, action]
+            new_value = old_value + alpha * (reward + discount_factor * q[next_state, next_action] - old_value)
+            q[state, action] = new_value
 
             # record performance statistics
-            update_size = abs(action.value - old_value)
+            update_size = abs(new_value - old_value)
             change_in_episode += update_size
 
             # move on to the next state and action (on-policy)
@@ -148,15 +124,42 @@ def perform_sarsa():
 
         change_per_episode_sarsa.append(change_in_episode)
         reward_per_episode_sarsa.append(reward_sum)
+
+        # stop once the monitor sees convergence
+        if monitor is not None and monitor.update(change_in_episode, q, environment.valid):
+            break
+
         time += 1
 
+    if monitor is not None:
+        monitor.finish()
+
     return(change_per_episode_sarsa, reward_per_episode_sarsa)
 
 
-def perform_qlearning():
+def perform_qlearning(rng=None, backend="python", exploration=None, monitor=None):
 
     ''' Performs Q-learning (off-policy TD) to estimate optimal state-action value'''
 
+    stream = RandomStream(rng)
+
+    if kernel_backend(backend) == "numba":
+        # the compiled episode kernels of tabular on the same Q array and draws
+        return run_kernel_episodes(environment, grid.q, "qlearning", episodes, alpha, discount_factor,
+                                   exploration_epsilon(exploration, inverse_time), random_start, stream, monitor)
+
+    # precompiled environment: a step is two table lookups
+    next_states, rewards, terminal = environment.next_state_list, environment.reward_list, environment.terminal_list
+    q = grid.q
+    n_valid = grid.n_valid_list
+
+    if exploration is None:
+        exploration = EpsilonGreedy(inverse_time)
+    exploration.reset(environment.n_states, environment.n_actions)
+
+    if monitor is not None:
+        monitor.start()
+
     time = 1
 
     # performance statistics
@@ -166,34 +169,32 @@ def perform_qlearning():
     while time < episodes:
 
         # select a random starting state (that is not inside a wall!)
-        state = random.choice(random.choice(grid))
-        while state.wall:
-            state = random.choice(random.choice(grid))
+        state = random_start(stream)
 
         # performance statistics
         change_in_episode = 0
         reward_sum = 0
 
-        while not state.treasure and not state.snakepit:
+        while not terminal[state]:
 
-            # select action following an epsilon greedy policy
-            action = epsilon_greedy(state, time)
+            # select action following the exploration policy
+            action = exploration.action(q, state, n_valid[state], time, stream)
 
             # follow defined action and observe reward and next state
-            moved = move(state, action)
-            next_state = moved[0]
-            reward = moved[1]
+            next_state = next_states[state][action]
+            reward = rewards[state][action]
             reward_sum += reward
 
-            # define the exploitative action in the next state
-            exploitative_action = exploitative_policy(next_state)
+            # define the value of the exploitative action in the next state
+            exploitative_value = grid.max_value(next_state)
 
             # update Q-value of the state-action
-            old_value = action.value
-            action.value = action.value + alpha * (reward + discount_factor * exploitative_action.value - action.value)
+            old_value = q[state, action]
+            new_value = old_value + alpha * (reward + discount_factor * exploitative_value - old_value)
+            q[state, action] = new_value
 
             # record performance statistics
-            update_size = abs(action.value - old_value)
+            update_size = abs(new_value - old_value)
             change_in_episode += update_size
 
             # move on to the next state
@@ -201,52 +202,37 @@ def perform_qlearning():
 
         change_per_episode_qlearning.append(change_in_episode)
         reward_per_episode_qlearning.append(reward_sum)
-        time +=1
-
-    return(change_per_episode_qlearning, reward_per_episode_qlearning)
 
+        # stop once the monitor sees convergence
+        if monitor is not None and monitor.update(change_in_episode, q, environment.valid):
+            break
 
-def move(state, action):
+        time +=1
 
-    '''Following an action in a state, returns consecutive state and received reward'''
+    if monitor is not None:
+        monitor.finish()
 
-    # calculate the new aimed-for position
-    if action.direction == "N":
-        move_to = np.add(state.position, [-1, 0])
-    elif action.direction == "S":
-        move_to = np.add(state.position, [1, 0])
-    elif action.direction == "W":
-        move_to = np.add(state.position, [0, -1])
-    elif action.direction == "E":
-        move_to = np.add(state.position, [0, 1])
+    return(change_per_episode_qlearning, reward_per_episode_qlearning)
 
 
-    # we must stay within the grid, else stay in current position
-    if move_to[0] > grid_rows or move_to[0] < 0 \
-        or move_to[1] > grid_columns or move_to[1] < 0:
+def perform_learner(algorithm, rng=None, exploration=None, **parameters):
 
-        next_state = state
-        reward = -1
+    '''Performs one of the learners of tabular.td_learners (Expected SARSA, n-step SARSA,
+    SARSA(lambda), Watkins's Q(lambda), Dyna-Q or Dyna-Q+); parameters such as n_steps,
+    trace_decay or planning_steps are passed on to tabular.run_td_learner'''
 
-    else:
+    if exploration is None:
+        exploration = EpsilonGreedy(inverse_time)
 
-        considered_state = grid[move_to[0]][move_to[1]]
+    return run_td_learner(environment, grid.q, algorithm, episodes, alpha, discount_factor, exploration,
+                          random_start, RandomStream(rng), **parameters)
 
-        if considered_state.wall:
-            next_state = state
-            reward = -1
 
-        else:
-            next_state = considered_state
+def move(state, action):
 
-            if considered_state.snakepit:
-                reward = -20
-            elif considered_state.treasure:
-                reward = 10
-            else:
-                reward = -1
+    '''Following an action in a state (both ids), returns consecutive state and received reward'''
 
-    return (next_state, reward)
+    return environment.step(state, action)
 
 
 
@@ -254,36 +240,17 @@ def exploitative_policy(state):
 
     '''Find the exploitative action in a state (ie state with higest value)'''
 
-    # initialize to arbitrarily low value
-    current_high = -math.inf
+    return grid.greedy_action(state)
 
-    # consider all state-actions and choose action with highest value
-    for action in state.actions:
-        if action.value > current_high:
-            current_high = action.value
-            optimal_action = action
 
-    return optimal_action
 
-
-
-def epsilon_greedy(state, time):
+def epsilon_greedy(state, time, stream):
 
     '''A GLIE version of epsilon-greedy policy selection. The probability to select
-    a random action rather than a greedy one decreases over time.'''
-
-    # follow a GLIE policy: 1 / timesteps
-    pol_choice = random.uniform(0, 1)
-
-    # below threshold choose the explorative (random) action
-    if pol_choice < 1/time:
-        action = random.choice(state.actions)
+    a random action rather than a greedy one decreases over time: 1 / timesteps
+    (see tabular.EpsilonGreedy).'''
 
-    # above threshold choose an exploitative (maximizing) action
-    else:
-        action = exploitative_policy(state)
-
-    return action
+    return EpsilonGreedy(inverse_time).action(grid.q, state, grid.n_valid_list[state], time, stream)
 
 
 
@@ -291,19 +258,11 @@ def extract_optimal_policy():
 
     '''For all states, select the action with the highest Q-value as the optimal one.'''
 
-    # consider all states in the grid
-    for row in range(grid_rows+1):
-        for column in range(grid_columns+1):
-
-            state = grid[row][column]
+    best_actions = grid.masked_values().argmax(axis=2)
 
-            # consider all actions and save that with highest value
-            optimal_value = -math.inf
-
-            for action in state.actions:
-                if action.value > optimal_value:
-                    optimal_value = action.value
-                    state.optimal_action = action.direction
+    for row in range(grid.rows):
+        for column in range(grid.columns):
+            grid.optimal_action[row, column] = grid.direction(environment.state_id((row, column)), best_actions[row, column])
 
 
 
@@ -313,7 +272,7 @@ def print_grid(grid):
 
     for row in range(grid_rows+1):
         for column in range(grid_columns+1):
-            print(grid[row][column].optimal_action, end = '')
+            print(grid.optimal_action[row, column], end = '')
             print(" | ", end = '')
         print("")
 
@@ -326,29 +285,27 @@ def print_SA_values():
     for row in range(grid_rows+1):
         for column in range(grid_columns+1):
 
-            state = grid[row][column]
+            print("State at position " + str([row, column]) + ":")
 
-            print("State at position " + str(state.position) + ":")
+            state = environment.state_id((row, column))
 
-            for action in state.actions:
-                print(action.direction + ": " + "%.2f" % action.value)
+            for action in range(grid.n_valid_list[state]):
+                print(grid.direction(state, action) + ": " + "%.2f" % grid.q[state, action])
 
             print()
 
-def plot_results(results, index, num_plots, plot_rewards=True, title=None, label="run", final_plot=False):
-    #change_smoothed_sarsa = pd.Series(reward_per_episode_sarsa).rolling(smoothing_window, min_periods=smoothing_window).mean()
+def plot_results(results, index, num_plots, plot_rewards=True, title=None, label="run", final_plot=False, band=None):
 
-    num = len(results)
+    '''Plot the mean curve of an experiment from its [change, rewards] pair of
+    CurveStatistics. band can add a shaded area: "std" for one standard deviation
+    around the mean, or a (low, high) pair of quantiles (needs a sample_size).'''
 
-    if plot_rewards:
-        results = [results[i][1] for i in range(num)]
-    else:
-        results = [results[i][0] for i in range(num)]
+    #change_smoothed_sarsa = pd.Series(reward_per_episode_sarsa).rolling(smoothing_window, min_periods=smoothing_window).mean()
 
-    mean = [np.mean([results[j][i] for j in range(num)]) for i in range(episodes-1)]
-    std = [np.std([results[j][i] for j in range(num)]) for i in range(episodes-1)]
+    statistics = results[1] if plot_rewards else results[0]
 
-    epochs = list(range(episodes-1))
+    mean = statistics.mean
+    epochs = np.arange(len(mean))
 
     clrs = sns.color_palette("muted", num_plots)
 
@@ -362,55 +319,131 @@ def plot_results(results, index, num_plots, plot_rewards=True, title=None, label
 
     plt.plot(epochs, mean, label=label, c=clrs[index])
 
-    #plt.fill_between(epochs, [mean[i]-std[i] for i in range(episodes-1)], [mean[i]+std[i] for i in range(episodes-1)], alpha=0.3, facecolor=clrs[index])
+    if band == "std":
+        plt.fill_between(epochs, mean - statistics.std(), mean + statistics.std(), alpha=0.3, facecolor=clrs[index])
+    elif band is not None:
+        low, high = statistics.quantile(band)
+        plt.fill_between(epochs, low, high, alpha=0.3, facecolor=clrs[index])
 
     if final_plot:
          plt.legend()
          plt.show()
 
-def run_experiment_sarsa(n=10):
+def run_experiment_sarsa(n=10, rng=None, batched=True, sample_size=0, backend="python", exploration=None,
+                         monitor=None):
     global grid
 
-    results = []
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if batched and monitor is not None:
+        raise ValueError("Replicas train in lockstep when batched: use batched=False to stop them early")
+
+    if batched and backend != "python":
+        raise ValueError("Batched replicas train with the NumPy lockstep engine: use batched=False for the {} backend"
+                         .format(backend))
+
+    if batched:
+        return run_batched_experiment("sarsa", n, rng, sample_size, exploration_epsilon(exploration, inverse_time))
+
+    results = curve_statistics(episodes-1, sample_size, rng)
     for i in range(n):
         grid = initialize_grid(grid_rows, grid_columns)
-        change, rewards = perform_sarsa()
+        change, rewards = perform_sarsa(rng, backend, exploration, monitor)
         extract_optimal_policy()
-        results += [[change, rewards]]
+        results[0].add(change)
+        results[1].add(rewards)
 
     print_grid(grid)
     print()
+    if monitor is not None:
+        print(monitor.summary())
     return results
 
-def run_experiment_qlearning(n=10):
+def run_experiment_qlearning(n=10, rng=None, batched=True, sample_size=0, backend="python", exploration=None,
+                             monitor=None):
     global grid
 
-    results = []
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if batched and monitor is not None:
+        raise ValueError("Replicas train in lockstep when batched: use batched=False to stop them early")
+
+    if batched and backend != "python":
+        raise ValueError("Batched replicas train with the NumPy lockstep engine: use batched=False for the {} backend"
+                         .format(backend))
+
+    if batched:
+        return run_batched_experiment("qlearning", n, rng, sample_size, exploration_epsilon(exploration, inverse_time))
+
+    results = curve_statistics(episodes-1, sample_size, rng)
     for i in range(n):
         grid = initialize_grid(grid_rows, grid_columns)
-        change, rewards = perform_qlearning()
+        change, rewards = perform_qlearning(rng, backend, exploration, monitor)
         extract_optimal_policy()
-        results += [[change, rewards]]
+        results[0].add(change)
+        results[1].add(rewards)
 
     print_grid(grid)
     print()
+    if monitor is not None:
+        print(monitor.summary())
     return results
 
+def run_experiment_learner(algorithm, n=10, rng=None, sample_size=0, exploration=None, monitor=None,
+                           **parameters):
+    global grid
 
-def plot_grid():
+    if rng is None:
+        rng = np.random.default_rng()
 
-    results = np.ones(shape=(grid_rows+1, grid_columns+1)) * -math.inf
-    # consider all states in the grid
+    results = curve_statistics(episodes-1, sample_size, rng)
+    for i in range(n):
+        grid = initialize_grid(grid_rows, grid_columns)
+        change, rewards = perform_learner(algorithm, rng, exploration, monitor=monitor, **parameters)
+        extract_optimal_policy()
+        results[0].add(change)
+        results[1].add(rewards)
 
-    for row in range(grid_rows+1):
-        for column in range(grid_columns+1):
-            state = grid[row][column]
+    print_grid(grid)
+    print()
+    if monitor is not None:
+        print(monitor.summary())
+    return results
+
+def run_batched_experiment(algorithm, n, rng, sample_size=0, epsilon=inverse_time, chunk_size=250):
+
+    '''Train n replicas of an algorithm in lockstep (see tabular.run_batched_td), in
+    chunks whose curves are folded into the statistics'''
+
+    global grid
+
+    results = curve_statistics(episodes-1, sample_size, rng)
+
+    for chunk_start in range(0, n, chunk_size):
 
-            for action in state.actions:
-                results[row][column] = max(action.value, results[row][column])
+        # random starting states outside the walls, as in perform_sarsa/perform_qlearning
+        q, change, rewards = run_batched_td(environment, algorithm, min(chunk_size, n-chunk_start), episodes, alpha,
+                                            discount_factor, epsilon, np.flatnonzero(~environment.wall), rng=rng)
+        results[0].add_batch(change)
+        results[1].add_batch(rewards)
+
+    # show the policy of the last replica, like the serial experiments do
+    grid = initialize_grid(grid_rows, grid_columns)
+    grid.q[:] = q[-1]
+    extract_optimal_policy()
+
+    print_grid(grid)
+    print()
+    return results
+
+
+def plot_grid():
 
-            if state.wall or state.snakepit or state.treasure:
-                results[row][column] = np.nan
+    # the value of the best action in every state
+    results = grid.masked_values().max(axis=2)
+    results[grid.wall | grid.terminal] = np.nan
 
     fig, ax = plt.subplots()
     im = ax.imshow(results)
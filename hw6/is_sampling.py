@@ -1,84 +1,755 @@
+import os
+
 import numpy as np
-from scipy.stats import norm
-from scipy.stats import uniform
-import math as m
+import pandas as pd
+import matplotlib.pyplot as plt
+from scipy.stats import norm, qmc
+from scipy.special import logsumexp
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 
 TRUE_VALUE = 1
 
-def is_sampling(n, p, q):
+
+class Normal():
+
+    '''Normal distribution with vectorized logpdf and sampling'''
+
+    def __init__(self, mu=0, sigma=1):
+        self.mu = mu
+        self.sigma = sigma
+
+    def logpdf(self, x):
+        return norm.logpdf(x, self.mu, self.sigma)
+
+    def sample(self, n, rng):
+        return rng.normal(self.mu, self.sigma, n)
+
+    def ppf(self, u):
+        return norm.ppf(u, self.mu, self.sigma)
+
+    def __str__(self):
+        return "normal({}, {})".format(self.mu, self.sigma)
+
+
+class Uniform():
+
+    '''Uniform distribution on [a, b]'''
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def logpdf(self, x):
+        inside = (x >= self.a) & (x <= self.b)
+        return np.where(inside, -np.log(self.b - self.a), -np.inf)
+
+    def sample(self, n, rng):
+        return rng.uniform(self.a, self.b, n)
+
+    def ppf(self, u):
+        return self.a + u * (self.b - self.a)
+
+    def __str__(self):
+        return "uniform({}, {})".format(self.a, self.b)
+
+
+class Cosine():
+
+    '''The cosine distribution (1 + cos(pi x)) / 2 on [-1, 1]. E[X^2] = 1/3 - 2/pi^2.'''
+
+    true_value = 1/3 - 2/np.pi**2
+
+    def logpdf(self, x):
+        inside = np.abs(x) <= 1
+        with np.errstate(divide='ignore'):
+            return np.where(inside, np.log(cos_pdf(np.clip(x, -1, 1))), -np.inf)
+
+    def sample(self, n, rng):
+
+        # rejection sampling from the uniform distribution on [-1, 1] (the pdf is at most 1)
+        samples = np.empty(0)
+        while len(samples) < n:
+            x = rng.uniform(-1, 1, 2 * (n - len(samples)))
+            samples = np.concatenate([samples, x[rng.random(len(x)) < cos_pdf(x)]])
+
+        return samples[:n]
+
+    def __str__(self):
+        return "cosine"
+
+
+class Mixture():
+
+    '''Mixture of distributions with the given component weights'''
+
+    def __init__(self, components, weights):
+        self.components = list(components)
+        self.weights = np.asarray(weights, dtype=float) / np.sum(weights)
+
+    def logpdf(self, x):
+        return logsumexp([np.log(weight) + component.logpdf(x)
+                          for weight, component in zip(self.weights, self.components)], axis=0)
+
+    def sample(self, n, rng):
+        counts = rng.multinomial(n, self.weights)
+        samples = np.concatenate([component.sample(count, rng) for component, count in zip(self.components, counts)])
+
+        return rng.permutation(samples)
+
+    def __str__(self):
+        return "mixture of " + ", ".join(str(component) for component in self.components)
+
+
+# registry of (target p, proposal q) pairs by name; register() adds more
+pairs = {
+    ("normal", "uniform"): (Normal(0, 1), Uniform(-5, 5)),
+    ("cosine", "uniform"): (Cosine(), Uniform(-1, 1)),
+    ("normal", "normal"): (Normal(0, 1), Normal(0, np.sqrt(2))),
+    ("normal", "mixture"): (Normal(0, 1), Mixture([Normal(-1, 0.8), Normal(1, 0.8)], [0.5, 0.5])),
+    ("cosine", "normal"): (Cosine(), Normal(0, 0.5)),
+}
+
+# E[X^2] under the targets
+true_values = {"normal": TRUE_VALUE, "cosine": Cosine.true_value}
+
+
+def register(p, q, target, proposal):
+
+    '''Make a target/proposal pair available to is_sampling as (p, q); both need
+    vectorized logpdf(x) and sample(n, rng)'''
+
+    pairs[p, q] = (target, proposal)
+
+
+class ISResult():
+
+    '''Outcome of importance sampling: the estimate of E[X^2] under p, its standard
+    error and the effective sample size (sum w)^2 / sum w^2 of the n weights'''
+
+    def __init__(self, estimate, std_error, ess, n, p, q, seconds=None, workers=1):
+        self.estimate = estimate
+        self.std_error = std_error
+        self.ess = ess
+        self.n = n
+        self.p = p
+        self.q = q
+        self.seconds = seconds
+        self.workers = workers
+
+    def throughput(self):
+
+        '''Samples per second, if the run was timed'''
+
+        return self.n / self.seconds if self.seconds else None
+
+    def __str__(self):
+        lines = [
+            "-------IMPORTANCE SAMPLING WITH {} SAMPLES-------".format(self.n),
+            "Estimate of E[X^2] for {} pdf with {} proposal: {} ".format(self.p, self.q, self.estimate),
+            "Error: {}".format(self.estimate-true_values.get(self.p, TRUE_VALUE)),
+            "Standard error: {}".format(self.std_error),
+            "Effective sample size: {:.1f}".format(self.ess)]
+
+        if self.seconds:
+            lines.append("{:.3f} seconds on {} worker(s): {:.3g} samples/sec".format(
+                self.seconds, self.workers, self.throughput()))
+
+        return "\n".join(lines + ["----------------------------------------------------"])
+
+
+class ISAccumulator():
+
+    '''Online statistics of importance sampling, fed one chunk of samples at a time:
+    the running mean and sum of squared deviations of the weighted values (merged
+    per chunk, Chan et al.) and the sums of the weights and squared weights. Memory
+    does not depend on the number of samples. count is the number of samples;
+    observations the number of weighted values averaged, which is smaller when
+    samples are combined first (antithetic pairs).'''
+
+    def __init__(self):
+        self.count = 0
+        self.observations = 0
+        self.mean = 0.0
+        self.squares = 0.0
+        self.weight_sum = 0.0
+        self.weight_squares = 0.0
+
+    def add(self, values, log_weights):
+
+        '''Add a chunk of values f(x) with their log weights log p(x) - log q(x)'''
+
+        weights = np.exp(log_weights)
+        self.add_weighted(values * weights, weights)
+
+    def add_weighted(self, weighted, weights):
+
+        '''Add a chunk of weighted values (independent observations of the estimate)
+        together with the weights of all samples that went into them'''
+
+        n = len(weighted)
+        if n == 0:
+            return
+
+        chunk_mean = weighted.mean()
+        chunk_squares = ((weighted - chunk_mean) ** 2).sum()
+
+        total = self.observations + n
+        delta = chunk_mean - self.mean
+        self.mean += delta * n / total
+        self.squares += chunk_squares + delta ** 2 * self.observations * n / total
+        self.observations = total
+
+        self.count += len(weights)
+        self.weight_sum += weights.sum()
+        self.weight_squares += (weights ** 2).sum()
+
+    def merge(self, other):
+
+        '''Combine with the statistics of another (independent) stream of samples, as
+        if all of them had been added here'''
+
+        total = self.observations + other.observations
+        if total == 0:
+            return
+
+        delta = other.mean - self.mean
+        self.mean += delta * other.observations / total
+        self.squares += other.squares + delta ** 2 * self.observations * other.observations / total
+        self.observations = total
+
+        self.count += other.count
+        self.weight_sum += other.weight_sum
+        self.weight_squares += other.weight_squares
+
+    def estimate(self):
+        return self.mean
+
+    def std_error(self):
+        n = self.observations
+        return np.sqrt(self.squares / (n - 1) / n) if n > 1 else np.nan
+
+    def relative_error(self):
+        return self.std_error() / abs(self.estimate()) if self.estimate() else np.inf
+
+    def ess(self):
+        return self.weight_sum ** 2 / self.weight_squares if self.weight_squares else 0.0
+
+
+class SNISAccumulator(ISAccumulator):
+
+    '''Online statistics of self-normalized importance sampling, sum w f / sum w, which
+    only needs the target density up to a constant. The sums of the weights are
+    kept relative to exp(shift), the largest log weight seen so far, so that the
+    weights are never exponentiated in absolute terms. The standard error is the
+    delta-method one, sqrt(sum w^2 (f - estimate)^2) / sum w.'''
+
+    def __init__(self):
+        ISAccumulator.__init__(self)
+        self.shift = -np.inf
+        self.value_sum = 0.0
+        self.weighted_squares = 0.0
+        self.weighted_values = 0.0
+
+    def add(self, values, log_weights):
+
+        n = len(values)
+        if n == 0:
+            return
+
+        # rescale the running sums when a larger log weight comes in
+        shift = max(self.shift, log_weights.max())
+        if shift == -np.inf:
+            self.count += n
+            return
+
+        scale = np.exp(self.shift - shift) if self.shift > -np.inf else 0.0
+        self.shift = shift
+
+        weights = np.exp(log_weights - shift)
+
+        self.weight_sum = self.weight_sum * scale + weights.sum()
+        self.value_sum = self.value_sum * scale + (weights * values).sum()
+        self.weight_squares = self.weight_squares * scale**2 + (weights ** 2).sum()
+        self.weighted_values = self.weighted_values * scale**2 + (weights ** 2 * values).sum()
+        self.weighted_squares = self.weighted_squares * scale**2 + (weights ** 2 * values ** 2).sum()
+        self.count += n
+
+    def merge(self, other):
+
+        # bring both sets of sums to the larger shift before adding them
+        shift = max(self.shift, other.shift)
+        self.count += other.count
+
+        if shift == -np.inf:
+            return
+
+        scale = np.exp(self.shift - shift) if self.shift > -np.inf else 0.0
+        other_scale = np.exp(other.shift - shift) if other.shift > -np.inf else 0.0
+        self.shift = shift
+
+        for name, power in (("weight_sum", 1), ("value_sum", 1), ("weight_squares", 2),
+                            ("weighted_values", 2), ("weighted_squares", 2)):
+            setattr(self, name, getattr(self, name) * scale**power + getattr(other, name) * other_scale**power)
+
+    def estimate(self):
+        return self.value_sum / self.weight_sum if self.weight_sum else np.nan
+
+    def std_error(self):
+        if not self.weight_sum:
+            return np.nan
+
+        estimate = self.estimate()
+        deviations = self.weighted_squares - 2 * estimate * self.weighted_values + estimate ** 2 * self.weight_squares
+
+        return np.sqrt(max(deviations, 0)) / self.weight_sum
+
+
+class ControlVariateAccumulator(ISAccumulator):
+
+    '''Importance sampling with the weight w = p/q as control variate: E_q[w] = 1 for
+    normalized densities, so mean(f w) - beta (mean(w) - 1) is unbiased for any
+    beta, and the beta that minimizes its variance is cov(f w, w) / var(w),
+    estimated from the samples. Keeps the plain sums needed for that.'''
+
+    def __init__(self):
+        ISAccumulator.__init__(self)
+        self.value_sum = 0.0
+        self.value_squares = 0.0
+        self.cross_sum = 0.0
+
+    def add_weighted(self, weighted, weights):
+        ISAccumulator.add_weighted(self, weighted, weights)
+
+        self.value_sum += weighted.sum()
+        self.value_squares += (weighted ** 2).sum()
+        self.cross_sum += (weighted * weights).sum()
+
+    def merge(self, other):
+        ISAccumulator.merge(self, other)
+
+        self.value_sum += other.value_sum
+        self.value_squares += other.value_squares
+        self.cross_sum += other.cross_sum
+
+    def moments(self):
+
+        '''Means, variances and covariance of the weighted values and the weights'''
+
+        n = self.count
+        value_mean, weight_mean = self.value_sum / n, self.weight_sum / n
+        value_variance = self.value_squares / n - value_mean ** 2
+        weight_variance = self.weight_squares / n - weight_mean ** 2
+        covariance = self.cross_sum / n - value_mean * weight_mean
+
+        return value_mean, weight_mean, value_variance, weight_variance, covariance
+
+    def estimate(self):
+        if self.count < 2:
+            return self.mean
+
+        value_mean, weight_mean, value_variance, weight_variance, covariance = self.moments()
+        beta = covariance / weight_variance if weight_variance > 0 else 0.0
+
+        return value_mean - beta * (weight_mean - 1)
+
+    def std_error(self):
+        if self.count < 2:
+            return np.nan
+
+        value_mean, weight_mean, value_variance, weight_variance, covariance = self.moments()
+        residual = value_variance - (covariance ** 2 / weight_variance if weight_variance > 0 else 0.0)
+
+        return np.sqrt(max(residual, 0) / (self.count - 1))
+
+
+class StratifiedAccumulator(ISAccumulator):
+
+    '''Importance sampling stratified over equal-probability strata of the proposal:
+    keeps the running mean and squared deviations per stratum. The estimate is the
+    average of the stratum means and its variance sum(var_k / n_k) / strata^2.'''
+
+    def __init__(self, strata):
+        ISAccumulator.__init__(self)
+        self.strata = strata
+        self.stratum_count = np.zeros(strata)
+        self.stratum_mean = np.zeros(strata)
+        self.stratum_squares = np.zeros(strata)
+
+    def add_strata(self, weighted, weights, stratum):
+
+        '''Add a chunk of weighted values with the stratum of every sample'''
+
+        ISAccumulator.add_weighted(self, weighted, weights)
+
+        count = np.bincount(stratum, minlength=self.strata)
+        chunk_mean = np.bincount(stratum, weighted, self.strata) / np.maximum(count, 1)
+        chunk_squares = np.bincount(stratum, (weighted - chunk_mean[stratum]) ** 2, self.strata)
+
+        self.merge_strata(count, chunk_mean, chunk_squares)
+
+    def merge_strata(self, count, mean, squares):
+        total = self.stratum_count + count
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = mean - self.stratum_mean
+            self.stratum_mean = np.where(total > 0, self.stratum_mean + delta * count / total, 0)
+            self.stratum_squares = np.where(total > 0, self.stratum_squares + squares
+                                            + delta ** 2 * self.stratum_count * count / total, 0)
+
+        self.stratum_count = total
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+
+        if self.count == 0:
+            self.strata = other.strata
+            self.stratum_count = np.zeros(other.strata)
+            self.stratum_mean = np.zeros(other.strata)
+            self.stratum_squares = np.zeros(other.strata)
+
+        if other.strata != self.strata:
+            raise ValueError("Cannot merge {} strata into {} strata".format(other.strata, self.strata))
+
+        ISAccumulator.merge(self, other)
+        self.merge_strata(other.stratum_count, other.stratum_mean, other.stratum_squares)
+
+    def estimate(self):
+        return self.stratum_mean.mean()
+
+    def std_error(self):
+        if (self.stratum_count < 2).any():
+            return np.nan
+
+        variances = self.stratum_squares / (self.stratum_count - 1)
+
+        return np.sqrt((variances / self.stratum_count).sum()) / self.strata
+
+
+class ReplicateAccumulator(ISAccumulator):
+
+    '''Importance sampling in independent replicates (randomized quasi-Monte Carlo or
+    Latin hypercube batches), whose points are not independent within a replicate.
+    The estimate is the mean of the replicate estimates and its standard error
+    comes from their spread.'''
+
+    def __init__(self):
+        ISAccumulator.__init__(self)
+        self.replicates = ISAccumulator()
+        self.current = ISAccumulator()
+
+    def add_weighted(self, weighted, weights):
+        ISAccumulator.add_weighted(self, weighted, weights)
+        self.current.add_weighted(weighted, weights)
+
+    def end_replicate(self):
+        if self.current.count:
+            self.replicates.add_weighted(np.array([self.current.estimate()]), np.empty(0))
+        self.current = ISAccumulator()
+
+    def merge(self, other):
+        ISAccumulator.merge(self, other)
+        self.replicates.merge(other.replicates)
+
+    def estimate(self):
+        return self.replicates.estimate() if self.replicates.observations else self.mean
+
+    def std_error(self):
+        return self.replicates.std_error()
+
+
+sampling_modes = ["plain", "antithetic", "control-variate", "stratified", "latin-hypercube", "sobol"]
+
+
+def is_sampling(n, p, q, rng=None, chunk_size=1000000, target_relative_error=None, self_normalized=False,
+                mode="plain", **options):
 
     '''
 
-    Importance sampling for estimating E[X^2] of a normal / cosine
-    distribution, using random samples from a uniform distribution at a given
-    interval.
+    Importance sampling for estimating E[X^2] under the target p, using random
+    samples from the proposal q; (p, q) names a pair in the registry, such as
+    ("normal", "uniform") or ("cosine", "uniform"). Weights are computed in log
+    space from the logpdfs. The samples are streamed: drawn and weighted
+    chunk_size at a time into an accumulator, so memory stays constant however
+    large n is. self_normalized selects self-normalized importance sampling;
+    mode one of the variance reduction techniques of accumulate().
+
+    With a target_relative_error, sampling stops after the first chunk where the
+    standard error relative to the estimate is at most the target; n is then
+    the most samples to draw, or None for no limit. Returns an ISResult with
+    the number of samples actually drawn.
 
     '''
 
-    distr = {
-        "normal": 1,
-        "uniform": 2,
-        "cosine": 3
-    }
+    if rng is None:
+        rng = np.random.default_rng()
 
-    estimate = 0
+    if n is None and target_relative_error is None:
+        raise ValueError("Without a target relative error the number of samples n is needed")
 
-    # check for uniform q distribution
-    if distr[q] == 2:
+    started = perf_counter()
+    accumulator = accumulate(n, p, q, rng, chunk_size, target_relative_error, self_normalized, mode, **options)
 
-        # calculate importance sampling with normal distribution
-        if distr[p] == 1:
+    return ISResult(accumulator.estimate(), accumulator.std_error(), accumulator.ess(), accumulator.count, p, q,
+                    perf_counter() - started)
 
-            # set parameters and pdfs
-            mu_1, sigma_1 = 0, 1
-            a, b = -5, 5
-            p_x = norm(mu_1, sigma_1)
-            q_x = uniform(a,b-a)
 
-            # draw sample
-            X = np.random.uniform(a, b, n)
+def accumulate(n, p, q, rng, chunk_size=1000000, target_relative_error=None, self_normalized=False, mode="plain",
+               strata=100, replicates=16, total=None, offset=0):
 
-            # estimate expected value
-            for x in X:
-                estimate +=  pow(x,2) * p_x.pdf(x)/q_x.pdf(x)
+    '''The streaming loop of is_sampling: returns the accumulator after drawing the
+    samples. mode selects how the proposal is sampled:
 
-        # calculate importance sampling with cosine distribution
-        elif distr[p] == 3:
+    "plain": independent draws from the proposal
+    "antithetic": pairs x = F^-1(u), x' = F^-1(1 - u), averaged per pair
+    "control-variate": plain draws, with the weight (known mean 1) as control variate
+    "stratified": draws spread evenly over strata equal-probability strata (fewer
+    strata if n is below 2 * strata, so every stratum gets at least two draws)
+    "latin-hypercube": replicates of Latin hypercube samples (one per stratum)
+    "sobol": replicates of scrambled Sobol points (sizes rounded down to powers of 2)
 
-            # set parameters and pdf
-            a, b = -1, 1
-            q_x = uniform(a,b-a)
+    For the replicate modes target_relative_error is checked after every replicate,
+    and there are at most n replicates. When the n samples are one shard of a run
+    of total samples, the strata are fitted to total and this shard fills them
+    starting at its offset in the run, so that the shards merge into the same
+    allocation as a single run.
 
-            # draw sample
-            X = np.random.uniform(a, b, n)
+    All but "plain" and "control-variate" need a proposal with an inverse cdf (ppf),
+    and only "plain" supports self-normalized importance sampling.'''
 
-            # estimate expected value
-            for x in X:
-                estimate +=  pow(x,2) * cos_pdf(x)/q_x.pdf(x)
+    if (p, q) not in pairs:
+        raise ValueError("Unknown target/proposal pair: {}, {} (registered: {})".format(p, q, sorted(pairs)))
 
-        else:
-            print("Distribution of p must be either cosine or normal")
-            return 0
+    if mode not in sampling_modes:
+        raise ValueError("Unknown sampling mode: {} (one of {})".format(mode, sampling_modes))
+
+    target, proposal = pairs[p, q]
 
-        # multiply by inverse of number of samples
-        is_ratio = (1/n)*estimate
+    if self_normalized and mode != "plain":
+        raise ValueError("Self-normalized importance sampling only supports the plain mode")
 
-        print("-------IMPORTANCE SAMPLING WITH {} SAMPLES-------".format(n))
-        print("Estimate of E[X^2] for {} pdf: {} ".format(p, is_ratio))
-        print("Error: {}".format(is_ratio-TRUE_VALUE))
-        print("----------------------------------------------------")
+    if mode not in ("plain", "control-variate") and not hasattr(proposal, "ppf"):
+        raise ValueError("The {} mode needs a proposal with an inverse cdf".format(mode))
 
+    if mode in ("latin-hypercube", "sobol"):
+        return accumulate_replicates(n, target, proposal, rng, chunk_size, mode, replicates, target_relative_error)
+
+    if self_normalized:
+        accumulator = SNISAccumulator()
+    elif mode == "control-variate":
+        accumulator = ControlVariateAccumulator()
+    elif mode == "stratified":
+        if total is None:
+            total = n
+        if total is not None:
+            strata = max(1, min(strata, total // 2))
+        accumulator = StratifiedAccumulator(strata)
+        chunk_size = max(strata, chunk_size // strata * strata)
     else:
-        print("Distribution of q must be uniform")
-        return 0
+        accumulator = ISAccumulator()
+
+    while n is None or accumulator.count < n:
+
+        size = chunk_size if n is None else min(chunk_size, n - accumulator.count)
+
+        # draw sample
+        if mode == "antithetic":
+            u = rng.random((size + 1) // 2)
+            X = proposal.ppf(np.concatenate([u, 1 - u]))[:size]
+        elif mode == "stratified":
+            # strata are filled in turn across chunks, so their counts differ by at most one
+            stratum = (offset + accumulator.count + np.arange(size)) % strata
+            X = proposal.ppf((stratum + rng.random(size)) / strata)
+        else:
+            X = proposal.sample(size, rng)
+
+        log_weights = target.logpdf(X) - proposal.logpdf(X)
+
+        if self_normalized:
+            accumulator.add(X ** 2, log_weights)
+        else:
+            weights = np.exp(log_weights)
+            weighted = X ** 2 * weights
+
+            if mode == "antithetic":
+                # average every draw with its antithetic partner; an odd last draw stays alone
+                pairs_drawn = size // 2
+                half = (size + 1) // 2
+                averaged = (weighted[:pairs_drawn] + weighted[half:half+pairs_drawn]) / 2
+                accumulator.add_weighted(np.concatenate([averaged, weighted[pairs_drawn:half]]), weights)
+            elif mode == "stratified":
+                accumulator.add_strata(weighted, weights, stratum)
+            else:
+                accumulator.add_weighted(weighted, weights)
+
+        # stop early once the estimate is precise enough
+        if target_relative_error is not None and accumulator.relative_error() <= target_relative_error:
+            break
+
+    return accumulator
+
+
+def accumulate_replicates(n, target, proposal, rng, chunk_size, mode, replicates, target_relative_error=None):
+
+    '''The n samples as independent replicates of Latin hypercube samples or of
+    scrambled Sobol points, each drawn chunk_size at a time (for Sobol a power of
+    2, which keeps the balance of the points). Stops after a replicate once the
+    estimate reaches target_relative_error.'''
+
+    if n is None:
+        raise ValueError("The {} mode needs the number of samples n".format(mode))
+
+    # never more samples than n in total, so fewer replicates if n is small
+    replicates = min(replicates, n)
+    size = n // replicates if replicates else 0
+    if mode == "sobol" and size:
+        size = 2 ** int(np.log2(max(size, 1)))
+        chunk_size = 2 ** int(np.log2(max(chunk_size, 1)))
+
+    accumulator = ReplicateAccumulator()
+
+    for replicate in range(replicates):
+
+        if mode == "sobol":
+            engine = qmc.Sobol(d=1, scramble=True, seed=rng)
+
+        drawn = 0
+        while drawn < size:
+            chunk = min(chunk_size, size - drawn)
+
+            if mode == "sobol":
+                u = engine.random(chunk)[:, 0]
+            else:
+                u = qmc.LatinHypercube(d=1, seed=rng).random(chunk)[:, 0]
+
+            X = proposal.ppf(u)
+            weights = np.exp(target.logpdf(X) - proposal.logpdf(X))
+            accumulator.add_weighted(X ** 2 * weights, weights)
+
+            drawn += chunk
+
+        accumulator.end_replicate()
+
+        if target_relative_error is not None and accumulator.relative_error() <= target_relative_error:
+            break
+
+    return accumulator
+
+
+def run_shard(n, p, q, seed, chunk_size, self_normalized, mode="plain", options=None):
+
+    '''Worker for parallel_is_sampling(): one shard of the samples with its own random stream'''
+
+    return accumulate(n, p, q, np.random.default_rng(seed), chunk_size, self_normalized=self_normalized, mode=mode,
+                      **(options or {}))
+
+
+def parallel_is_sampling(n, p, q, workers=None, seed=None, shards=None, chunk_size=1000000, self_normalized=False,
+                         mode="plain", **options):
+
+    '''Importance sampling with the n samples split over shards (by default one per
+    worker, all cores by default) that run on a process pool. Every shard draws from its own child of one
+    SeedSequence, and the accumulators of the shards are merged exactly, so for a
+    fixed seed and number of shards the result does not depend on the number of
+    workers. options (strata, replicates) are passed on to accumulate(); the strata
+    are fitted to all n samples, not to each shard. Returns a timed ISResult.'''
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if shards is None:
+        shards = workers
+
+    if (p, q) not in pairs:
+        raise ValueError("Unknown target/proposal pair: {}, {} (registered: {})".format(p, q, sorted(pairs)))
+
+    seeds = np.random.SeedSequence(seed).spawn(shards)
+    sizes = [n // shards + (shard < n % shards) for shard in range(shards)]
+    offsets = np.cumsum([0] + sizes[:-1]).tolist()
+    shard_options = [dict(options, total=n, offset=offset) for offset in offsets]
+
+    started = perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partials = list(executor.map(run_shard, sizes, [p] * shards, [q] * shards, seeds,
+                                     [chunk_size] * shards, [self_normalized] * shards, [mode] * shards,
+                                     shard_options))
+
+    accumulator = partials[0]
+    for partial in partials[1:]:
+        accumulator.merge(partial)
+
+    return ISResult(accumulator.estimate(), accumulator.std_error(), accumulator.ess(), accumulator.count, p, q,
+                    perf_counter() - started, workers)
+
+
+def throughput(n, p, q, worker_counts=(1, 2, 4, 8), seed=None, chunk_size=1000000):
+
+    '''Time parallel_is_sampling on the same n samples (split into as many shards as the
+    largest worker count) for every worker count, and print the samples per second'''
+
+    results = []
+
+    for workers in worker_counts:
+        result = parallel_is_sampling(n, p, q, workers, seed, max(worker_counts), chunk_size)
+        results.append(result)
+
+        print("{} worker(s): {:.3f} seconds, {:.3g} samples/sec".format(workers, result.seconds, result.throughput()))
+
+    return results
+
+
+def compare_modes(p="normal", q="uniform", sample_sizes=(1000, 10000, 100000, 1000000), modes=None, repeats=20,
+                  seed=None):
+
+    '''Comparison harness of the sampling modes: runs every mode repeats times for every
+    sample size, and returns a DataFrame with the root mean squared error against the
+    true value, the mean reported standard error and the mean wall time per run'''
+
+    if modes is None:
+        modes = [mode for mode in sampling_modes if mode == "plain" or mode == "control-variate"
+                 or hasattr(pairs[p, q][1], "ppf")]
+
+    rng = np.random.default_rng(seed)
+    rows = []
+
+    for mode in modes:
+        for n in sample_sizes:
+            results = [is_sampling(n, p, q, rng, mode=mode) for repeat in range(repeats)]
+            errors = np.array([result.estimate for result in results]) - true_values.get(p, TRUE_VALUE)
+
+            rows.append({"mode": mode, "n": results[0].n, "rmse": np.sqrt((errors ** 2).mean()),
+                         "std_error": np.mean([result.std_error for result in results]),
+                         "seconds": np.mean([result.seconds for result in results])})
+
+    return pd.DataFrame(rows)
+
+
+def plot_comparison(table):
+
+    '''Error versus wall time of every mode in a compare_modes table, on log scales'''
+
+    for mode, rows in table.groupby("mode", sort=False):
+        plt.loglog(rows["seconds"], rows["rmse"], marker="o", label=mode)
+
+    plt.xlabel("seconds per estimate")
+    plt.ylabel("root mean squared error")
+    plt.legend()
+    plt.show()
+
 
 def cos_pdf(x):
 
-    ''' Probability distribution function of cosine function '''
+    ''' Probability distribution function of cosine function (elementwise on arrays) '''
 
-    return (1+m.cos(x * m.pi))/2
+    return (1+np.cos(x * np.pi))/2
 
 if __name__== '__main__':
     num_samples = 100000
-    is_sampling(num_samples,"normal","uniform")
-    is_sampling(num_samples,"cosine","uniform")
+    for p, q in sorted(pairs):
+        print(parallel_is_sampling(num_samples, p, q))
+
+    comparison = compare_modes("normal", "uniform")
+    print(comparison.to_string(index=False))
+    plot_comparison(comparison)
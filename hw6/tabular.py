@@ -0,0 +1,1123 @@
+#
+# Multi-Agent Systems 2018
+# Shared tabular backend for the gridworld and cliffwalking agents
+#
+
+import os
+import json
+import warnings
+from time import perf_counter
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# displacement of every action on the grid
+moves = {"N": (-1, 0), "S": (1, 0), "W": (0, -1), "E": (0, 1)}
+
+
+class GridEnvironment():
+
+    '''A grid layout compiled into integer next-state and reward tables indexed by
+    (state id, action id), so that a step is two lookups. State ids number the
+    cells row by row. Moving off the grid or into a wall leaves the agent in
+    place; entering a cell listed in entry_rewards gives that reward, any other
+    move gives step_reward. Walls and terminal cells only loop onto themselves.'''
+
+    def __init__(self, rows, columns, actions, walls=(), terminals=(), entry_rewards=None, step_reward=-1):
+
+        self.rows = rows
+        self.columns = columns
+        self.actions = list(actions)
+        self.n_states = rows * columns
+        self.n_actions = len(self.actions)
+
+        self.wall = np.zeros(self.n_states, dtype=bool)
+        self.terminal = np.zeros(self.n_states, dtype=bool)
+        self.wall[[self.state_id(cell) for cell in walls]] = True
+        self.terminal[[self.state_id(cell) for cell in terminals]] = True
+
+        entry_reward = np.full(self.n_states, step_reward, dtype=np.int64)
+        for cell, reward in (entry_rewards or {}).items():
+            entry_reward[self.state_id(cell)] = reward
+
+        states = np.arange(self.n_states)
+        rows_of, columns_of = np.divmod(states, columns)
+
+        self.next_state = np.empty((self.n_states, self.n_actions), dtype=np.int64)
+        self.reward = np.empty((self.n_states, self.n_actions), dtype=np.int64)
+
+        for a, action in enumerate(self.actions):
+            move_to_row = rows_of + moves[action][0]
+            move_to_column = columns_of + moves[action][1]
+
+            inside = (move_to_row >= 0) & (move_to_row < rows) & (move_to_column >= 0) & (move_to_column < columns)
+            move_to = np.where(inside, move_to_row * columns + move_to_column, states)
+
+            # we must stay within the grid and out of walls, else stay in current position
+            blocked = ~inside | self.wall[move_to]
+
+            self.next_state[:, a] = np.where(blocked, states, move_to)
+            self.reward[:, a] = np.where(blocked, step_reward, entry_reward[move_to])
+
+        self.next_state[self.wall | self.terminal] = states[self.wall | self.terminal, None]
+        self.reward[self.wall | self.terminal] = 0
+
+        # walls and terminal cells only have the single "X" action (index 0)
+        self.n_valid = np.where(self.wall | self.terminal, 1, self.n_actions)
+        self.valid = np.arange(self.n_actions) < self.n_valid[:, None]
+
+        # plain lists make the per-step lookups in the Python learners cheap
+        self.next_state_list = self.next_state.tolist()
+        self.reward_list = self.reward.tolist()
+        self.terminal_list = self.terminal.tolist()
+
+    def state_id(self, position):
+        return position[0] * self.columns + position[1]
+
+    def position(self, state):
+        return divmod(state, self.columns)
+
+    def step(self, state, action):
+
+        '''Following an action in a state, returns consecutive state and received reward'''
+
+        return self.next_state_list[state][action], self.reward_list[state][action]
+
+
+class QTable():
+
+    '''Holds all state-action values of a grid in one (rows, columns, actions)
+    array. Walls and terminal cells only have the single "X" action, which is
+    stored at action index 0; the other entries of those cells are masked out.'''
+
+    def __init__(self, rows, columns, actions, walls=(), terminals=(), initial_values=None):
+
+        self.rows = rows
+        self.columns = columns
+        self.actions = list(actions)
+
+        self.wall = np.zeros((rows, columns), dtype=bool)
+        self.terminal = np.zeros((rows, columns), dtype=bool)
+        for cell in walls:
+            self.wall[cell] = True
+        for cell in terminals:
+            self.terminal[cell] = True
+
+        # number of actions per cell: the valid ones are always the first n_valid
+        self.n_valid = np.where(self.wall | self.terminal, 1, len(self.actions))
+        self.valid = np.arange(len(self.actions)) < self.n_valid[:, :, None]
+
+        if initial_values is None:
+            self.values = np.zeros((rows, columns, len(self.actions)))
+        else:
+            self.values = np.array(initial_values, dtype=float).reshape(rows, columns, len(self.actions))
+
+        self.values[~self.valid] = 0
+
+        # the same values indexed by state id (row by row) instead of position
+        self.q = self.values.reshape(rows * columns, len(self.actions))
+        self.n_valid_list = self.n_valid.ravel().tolist()
+
+        self.optimal_action = np.full((rows, columns), "undefined", dtype=object)
+
+    def greedy_action(self, state):
+
+        '''Index of the valid action with the highest value in a state (first on ties)'''
+
+        return int(self.q[state, :self.n_valid_list[state]].argmax())
+
+    def max_value(self, state):
+
+        '''Highest value of the valid actions in a state'''
+
+        return self.q[state, :self.n_valid_list[state]].max()
+
+    def masked_values(self):
+
+        '''The values with invalid entries set to -inf, for argmax/max over whole grids'''
+
+        return np.where(self.valid, self.values, -np.inf)
+
+    def direction(self, state, action):
+
+        '''Label of an action: "X" in walls and terminal cells'''
+
+        if self.n_valid_list[state] == 1:
+            return "X"
+        return self.actions[action]
+
+
+class RandomStream():
+
+    '''Serves uniform draws from blocks pre-drawn from a numpy Generator, so that
+    per-step random decisions do not each call into the generator'''
+
+    def __init__(self, rng=None, block_size=4096):
+        if rng is None:
+            rng = np.random.default_rng()
+
+        self.rng = rng
+        self.block_size = block_size
+        self.refill()
+
+    def refill(self):
+        self.array = self.rng.random(self.block_size)
+        self.block = self.array.tolist()
+        self.index = 0
+
+    def uniform(self):
+        if self.index == len(self.block):
+            self.refill()
+
+        draw = self.block[self.index]
+        self.index += 1
+
+        return draw
+
+    def choice(self, options):
+        return options[int(self.uniform() * len(options))]
+
+    def take(self, minimum):
+
+        '''The unused draws as an array, at least minimum of them: the next block is
+        drawn early and appended to what is left, so the draws come in the same order
+        as through uniform(). Mark the draws that were used with advance().'''
+
+        if len(self.array) - self.index < minimum:
+            self.array = np.concatenate([self.array[self.index:], self.rng.random(self.block_size)])
+            self.block = self.array.tolist()
+            self.index = 0
+
+        return self.array[self.index:]
+
+    def advance(self, used):
+        self.index += used
+
+
+def inverse_time(time):
+
+    '''GLIE epsilon schedule: 1 / t in episode t'''
+
+    return 1 / time
+
+
+def exponential_decay(start=1.0, rate=0.99, minimum=0.01):
+
+    '''Schedule that starts at start and is multiplied by rate every episode, down to minimum'''
+
+    return lambda time: max(minimum, start * rate ** (time - 1))
+
+
+def scheduled(parameter, time):
+
+    '''Value of a parameter that is either a number or a schedule (function of the episode)'''
+
+    return parameter(time) if callable(parameter) else parameter
+
+
+class Exploration():
+
+    '''Interface of the exploration strategies of the agents. action() picks the
+    action in a state from the Q array, given the number of valid actions there and
+    the episode number, taking its random draws from a RandomStream (which draws them
+    from the generator in blocks). reset() is called before every training run.'''
+
+    def reset(self, n_states, n_actions):
+        pass
+
+    def action(self, q, state, n_valid, time, stream):
+        raise NotImplementedError
+
+    def probabilities(self, q, state, n_valid, time):
+
+        '''Probability of every valid action in a state (for Expected SARSA)'''
+
+        raise NotImplementedError
+
+
+class EpsilonGreedy(Exploration):
+
+    '''A random valid action with probability epsilon, else the greedy one (first on
+    ties). epsilon is a number or a schedule such as inverse_time.'''
+
+    def __init__(self, epsilon=inverse_time):
+        self.schedule = epsilon
+
+    def epsilon(self, time):
+        return scheduled(self.schedule, time)
+
+    def action(self, q, state, n_valid, time, stream):
+
+        # below epsilon choose the explorative (random) action
+        if stream.uniform() < self.epsilon(time):
+            return int(stream.uniform() * n_valid)
+
+        # above epsilon choose an exploitative (maximizing) action
+        return int(q[state, :n_valid].argmax())
+
+    def probabilities(self, q, state, n_valid, time):
+        epsilon = self.epsilon(time)
+
+        probabilities = np.full(n_valid, epsilon / n_valid)
+        probabilities[q[state, :n_valid].argmax()] += 1 - epsilon
+
+        return probabilities
+
+
+class Boltzmann(Exploration):
+
+    '''Softmax exploration: valid actions are chosen with probability proportional to
+    exp(Q / temperature), by inverting the cumulative distribution with a single
+    draw. temperature is a number or a schedule.'''
+
+    def __init__(self, temperature=1.0):
+        self.temperature = temperature
+
+    def action(self, q, state, n_valid, time, stream):
+
+        preferences = q[state, :n_valid] / scheduled(self.temperature, time)
+        cumulative = np.cumsum(np.exp(preferences - preferences.max()))
+
+        return min(int(np.searchsorted(cumulative, stream.uniform() * cumulative[-1], side="right")), n_valid - 1)
+
+    def probabilities(self, q, state, n_valid, time):
+
+        preferences = q[state, :n_valid] / scheduled(self.temperature, time)
+        weights = np.exp(preferences - preferences.max())
+
+        return weights / weights.sum()
+
+
+class UCBExploration(Exploration):
+
+    '''Count-based exploration: the action maximizing Q + c * sqrt(ln N(s) / N(s, a)),
+    where N counts the visits of the state and the state-action in this training run.
+    Untried actions go first. Needs no random draws.'''
+
+    def __init__(self, c=1.0):
+        self.c = c
+
+    def reset(self, n_states, n_actions):
+        self.state_count = np.zeros(n_states)
+        self.count = np.zeros((n_states, n_actions))
+
+    def action(self, q, state, n_valid, time, stream):
+
+        counts = self.count[state, :n_valid]
+
+        if (counts == 0).any():
+            action = int((counts == 0).argmax())
+        else:
+            bonus = self.c * np.sqrt(np.log(self.state_count[state]) / counts)
+            action = int((q[state, :n_valid] + bonus).argmax())
+
+        self.state_count[state] += 1
+        self.count[state, action] += 1
+
+        return action
+
+    def probabilities(self, q, state, n_valid, time):
+
+        # deterministic: all weight on the action that would be picked next, without counting it
+        counts = self.count[state, :n_valid]
+        probabilities = np.zeros(n_valid)
+
+        if (counts == 0).any():
+            probabilities[(counts == 0).argmax()] = 1
+        else:
+            bonus = self.c * np.sqrt(np.log(self.state_count[state]) / counts)
+            probabilities[(q[state, :n_valid] + bonus).argmax()] = 1
+
+        return probabilities
+
+
+def exploration_epsilon(exploration, default):
+
+    '''The epsilon (schedule) of an exploration strategy, for the engines that only
+    implement epsilon-greedy exploration; default when no strategy is given'''
+
+    if exploration is None:
+        return default
+
+    if not isinstance(exploration, EpsilonGreedy):
+        raise ValueError("Only epsilon-greedy exploration is supported here: train with batched=False, backend='python'")
+
+    return exploration.schedule
+
+
+class ConvergenceMonitor():
+
+    '''Stops a training run once it has converged, by one of two criteria:
+    "change" when an exponential moving average (weight smoothing) of the summed
+    update size per episode stays below tolerance for window consecutive episodes,
+    or "policy" when the greedy policy over the valid actions stays the same for
+    window consecutive episodes. No run stops before min_episodes. The training
+    loops call start(), update() after every episode (stopping when it returns
+    True) and finish(); runs keeps (episodes, seconds, converged) of every run.'''
+
+    def __init__(self, criterion="change", tolerance=0.01, window=20, smoothing=0.1, min_episodes=0):
+        if criterion not in ("change", "policy"):
+            raise ValueError("Unknown convergence criterion: {}".format(criterion))
+
+        self.criterion = criterion
+        self.tolerance = tolerance
+        self.window = window
+        self.smoothing = smoothing
+        self.min_episodes = min_episodes
+        self.runs = []
+
+    def start(self):
+        self.started = perf_counter()
+        self.episodes = 0
+        self.streak = 0
+        self.smoothed = None
+        self.policy = None
+        self.converged = False
+
+    def update(self, change, q, valid):
+
+        '''Record an episode with the given summed update size, given the Q array and
+        valid action mask after it; returns whether the run has converged'''
+
+        self.episodes += 1
+
+        if self.criterion == "change":
+            self.smoothed = change if self.smoothed is None else \
+                self.smoothing * change + (1 - self.smoothing) * self.smoothed
+            steady = self.smoothed < self.tolerance
+        else:
+            policy = np.where(valid, q, -np.inf).argmax(axis=1)
+            steady = self.policy is not None and np.array_equal(policy, self.policy)
+            self.policy = policy
+
+        self.streak = self.streak + 1 if steady else 0
+        self.converged = self.streak >= self.window and self.episodes >= self.min_episodes
+
+        return self.converged
+
+    def finish(self):
+        self.runs.append((self.episodes, perf_counter() - self.started, self.converged))
+
+    def summary(self):
+
+        '''Episode counts and wall time of the finished runs'''
+
+        if not self.runs:
+            return "No runs finished"
+
+        episodes, seconds, converged = (np.array(column) for column in zip(*self.runs))
+
+        return ("{} of {} runs converged; episodes mean {:.1f} (min {}, max {}); "
+                "{:.3f} s per run, {:.2f} s in total").format(
+                    converged.sum(), len(self.runs), episodes.mean(), episodes.min(), episodes.max(),
+                    seconds.mean(), seconds.sum())
+
+
+# learners beyond one-step SARSA and Q-learning, all run by run_td_learner
+td_learners = ["expected-sarsa", "n-step-sarsa", "sarsa-lambda", "watkins-q-lambda", "dyna-q", "dyna-q+"]
+
+
+def expected_sarsa_episode(environment, q, alpha, discount_factor, exploration, state, time, stream):
+
+    '''One episode of Expected SARSA: the target averages the next action values over
+    the probabilities of the exploration policy instead of sampling one action'''
+
+    change_in_episode = 0.0
+    reward_sum = 0
+
+    while not environment.terminal_list[state]:
+
+        action = exploration.action(q, state, environment.n_valid[state], time, stream)
+        next_state, reward = environment.step(state, action)
+        reward_sum += reward
+
+        target = reward
+        if not environment.terminal_list[next_state]:
+            n_valid = environment.n_valid[next_state]
+            probabilities = exploration.probabilities(q, next_state, n_valid, time)
+            target += discount_factor * probabilities.dot(q[next_state, :n_valid])
+
+        old_value = q[state, action]
+        q[state, action] = old_value + alpha * (target - old_value)
+        change_in_episode += abs(q[state, action] - old_value)
+
+        state = next_state
+
+    return change_in_episode, reward_sum
+
+
+def n_step_sarsa_episode(environment, q, alpha, discount_factor, exploration, state, time, stream, n_steps):
+
+    '''One episode of n-step SARSA (Sutton & Barto p. 147): every state-action is updated
+    towards the next n rewards plus the discounted value n steps later. Only the
+    last n+1 steps are kept, in circular buffers.'''
+
+    if environment.terminal_list[state]:
+        return 0.0, 0
+
+    size = n_steps + 1
+    states, actions, rewards = [0] * size, [0] * size, [0] * size
+
+    states[0] = state
+    actions[0] = exploration.action(q, state, environment.n_valid[state], time, stream)
+
+    change_in_episode = 0.0
+    reward_sum = 0
+
+    end = float("inf")
+    t = 0
+
+    while True:
+
+        if t < end:
+            next_state, reward = environment.step(states[t % size], actions[t % size])
+            reward_sum += reward
+
+            states[(t+1) % size], rewards[(t+1) % size] = next_state, reward
+
+            if environment.terminal_list[next_state]:
+                end = t + 1
+            else:
+                actions[(t+1) % size] = exploration.action(q, next_state, environment.n_valid[next_state], time, stream)
+
+        # the time step whose state-action is updated now
+        updated = t - n_steps + 1
+
+        if updated >= 0:
+            target = 0.0
+            for i in range(min(updated + n_steps, end), updated, -1):
+                target = rewards[i % size] + discount_factor * target
+
+            if updated + n_steps < end:
+                bootstrap = (updated + n_steps) % size
+                target += discount_factor ** n_steps * q[states[bootstrap], actions[bootstrap]]
+
+            state, action = states[updated % size], actions[updated % size]
+            old_value = q[state, action]
+            q[state, action] = old_value + alpha * (target - old_value)
+            change_in_episode += abs(q[state, action] - old_value)
+
+        if updated >= end - 1:
+            return change_in_episode, reward_sum
+
+        t += 1
+
+
+def lambda_episode(environment, q, alpha, discount_factor, exploration, state, time, stream, trace_decay,
+                   trace_cutoff, watkins=False):
+
+    '''One episode of SARSA(lambda), or of Watkins's Q(lambda) when watkins is set
+    (Sutton & Barto p. 303 and 312). Replacing eligibility traces are kept in a dict
+    of only the visited state-actions; a trace is dropped once it decays below
+    trace_cutoff, which bounds the work per step. Watkins's Q(lambda) bootstraps on
+    the greedy action and cuts all traces after an exploratory action.'''
+
+    traces = {}
+
+    change_in_episode = 0.0
+    reward_sum = 0
+
+    action = exploration.action(q, state, environment.n_valid[state], time, stream)
+
+    while not environment.terminal_list[state]:
+
+        next_state, reward = environment.step(state, action)
+        reward_sum += reward
+
+        if environment.terminal_list[next_state]:
+            next_action, target = 0, reward
+        else:
+            n_valid = environment.n_valid[next_state]
+            next_action = exploration.action(q, next_state, n_valid, time, stream)
+
+            if watkins:
+                greedy = int(q[next_state, :n_valid].argmax())
+                if q[next_state, next_action] == q[next_state, greedy]:
+                    greedy = next_action
+                target = reward + discount_factor * q[next_state, greedy]
+            else:
+                target = reward + discount_factor * q[next_state, next_action]
+
+        error = target - q[state, action]
+        traces[state, action] = 1.0
+
+        decay = discount_factor * trace_decay
+        if watkins and not environment.terminal_list[next_state] and next_action != greedy:
+            decay = 0.0
+
+        for (trace_state, trace_action), trace in list(traces.items()):
+            q[trace_state, trace_action] += alpha * error * trace
+            change_in_episode += abs(alpha * error * trace)
+
+            if trace * decay < trace_cutoff:
+                del traces[trace_state, trace_action]
+            else:
+                traces[trace_state, trace_action] = trace * decay
+
+        state, action = next_state, next_action
+
+    return change_in_episode, reward_sum
+
+
+class DynaModel():
+
+    '''The learned model of Dyna-Q: the last observed next state and reward of every
+    state-action, in arrays indexed by (state, action), plus the flat indices of the
+    state-actions observed so far so that planning can sample them uniformly in O(1).
+    last_step holds the real step at which each state-action was last tried, for the
+    exploration bonus of Dyna-Q+.'''
+
+    def __init__(self, n_states, n_actions):
+        self.n_actions = n_actions
+
+        self.next_state = np.full((n_states, n_actions), -1, dtype=np.int64)
+        self.reward = np.zeros((n_states, n_actions))
+        self.last_step = np.zeros((n_states, n_actions))
+
+        self.observed = np.empty(n_states * n_actions, dtype=np.int64)
+        self.n_observed = 0
+        self.step = 0
+
+    def record(self, state, action, next_state, reward):
+        if self.next_state[state, action] < 0:
+            self.observed[self.n_observed] = state * self.n_actions + action
+            self.n_observed += 1
+
+        self.next_state[state, action] = next_state
+        self.reward[state, action] = reward
+
+        self.step += 1
+        self.last_step[state, action] = self.step
+
+    def sample(self, uniforms):
+
+        '''States and actions of observed state-actions, one for every uniform draw'''
+
+        chosen = self.observed[(uniforms * self.n_observed).astype(np.int64)]
+
+        return np.divmod(chosen, self.n_actions)
+
+
+def dyna_q_episode(environment, q, alpha, discount_factor, exploration, state, time, stream, model, planning_steps,
+                   kappa):
+
+    '''One episode of Dyna-Q (Sutton & Barto p. 164): every real step is a Q-learning
+    update that is also recorded in the model, followed by planning_steps updates on
+    state-actions sampled from the model. The planning updates are done together with
+    array operations (when a state-action is sampled twice, one of its updates is
+    kept). With kappa > 0 this is Dyna-Q+: planning rewards get a bonus of
+    kappa * sqrt(steps since the state-action was last tried).'''
+
+    change_in_episode = 0.0
+    reward_sum = 0
+
+    valid = environment.valid
+    terminal = environment.terminal
+
+    while not environment.terminal_list[state]:
+
+        # direct reinforcement learning on the real step
+        action = exploration.action(q, state, environment.n_valid[state], time, stream)
+        next_state, reward = environment.step(state, action)
+        reward_sum += reward
+
+        target = reward
+        if not environment.terminal_list[next_state]:
+            target += discount_factor * q[next_state, :environment.n_valid[next_state]].max()
+
+        old_value = q[state, action]
+        q[state, action] = old_value + alpha * (target - old_value)
+        change_in_episode += abs(q[state, action] - old_value)
+
+        model.record(state, action, next_state, reward)
+
+        # planning on simulated steps from the model
+        if planning_steps:
+            states, actions = model.sample(stream.take(planning_steps)[:planning_steps])
+            stream.advance(planning_steps)
+
+            next_states = model.next_state[states, actions]
+            rewards = model.reward[states, actions]
+            if kappa:
+                rewards = rewards + kappa * np.sqrt(model.step - model.last_step[states, actions])
+
+            next_values = np.where(valid[next_states], q[next_states], -np.inf).max(axis=1)
+            targets = rewards + discount_factor * np.where(terminal[next_states], 0, next_values)
+
+            old_values = q[states, actions]
+            q[states, actions] = old_values + alpha * (targets - old_values)
+
+            # count the change of every updated entry once, as it was actually written
+            updated = np.unique(states * environment.n_actions + actions, return_index=True)[1]
+            change_in_episode += np.abs(q[states[updated], actions[updated]] - old_values[updated]).sum()
+
+        state = next_state
+
+    return change_in_episode, reward_sum
+
+
+def run_td_learner(environment, q, algorithm, episodes, alpha, discount_factor, exploration, start_state, stream,
+                   n_steps=4, trace_decay=0.8, trace_cutoff=0.0001, planning_steps=10, kappa=0.001, monitor=None):
+
+    '''Train one agent with one of the td_learners on the Q array q (states, actions).
+    start_state is a function of the RandomStream that gives the starting state id;
+    n_steps is used by n-step SARSA, trace_decay (lambda) and trace_cutoff by the
+    trace methods, planning_steps by Dyna-Q and kappa by Dyna-Q+. A ConvergenceMonitor
+    can stop the training early. Terminal states are not bootstrapped from. Like perform_sarsa
+    and perform_qlearning, runs episodes-1 episodes and returns the lists of summed
+    update sizes and rewards per episode.'''
+
+    if algorithm not in td_learners:
+        raise ValueError("Unknown learner: {}".format(algorithm))
+
+    exploration.reset(environment.n_states, environment.n_actions)
+    model = DynaModel(environment.n_states, environment.n_actions)
+
+    if monitor is not None:
+        monitor.start()
+
+    change_per_episode = []
+    reward_per_episode = []
+
+    for time in range(1, episodes):
+
+        state = start_state(stream)
+
+        if algorithm == "expected-sarsa":
+            change, rewards = expected_sarsa_episode(environment, q, alpha, discount_factor, exploration, state,
+                                                     time, stream)
+        elif algorithm in ("dyna-q", "dyna-q+"):
+            change, rewards = dyna_q_episode(environment, q, alpha, discount_factor, exploration, state, time,
+                                             stream, model, planning_steps, kappa if algorithm == "dyna-q+" else 0)
+        elif algorithm == "n-step-sarsa":
+            change, rewards = n_step_sarsa_episode(environment, q, alpha, discount_factor, exploration, state,
+                                                   time, stream, n_steps)
+        else:
+            change, rewards = lambda_episode(environment, q, alpha, discount_factor, exploration, state, time,
+                                             stream, trace_decay, trace_cutoff,
+                                             watkins=algorithm == "watkins-q-lambda")
+
+        change_per_episode.append(change)
+        reward_per_episode.append(rewards)
+
+        if monitor is not None and monitor.update(change, q, environment.valid):
+            break
+
+    if monitor is not None:
+        monitor.finish()
+
+    return change_per_episode, reward_per_episode
+
+
+def build_kernels(compile=None):
+
+    '''The episode kernels over plain arrays, compiled with compile (numba.njit) if
+    given: returns the (epsilon_greedy, td_steps) pair'''
+
+    if compile is None:
+        compile = lambda function: function
+
+    @compile
+    def epsilon_greedy(q, state, n_valid, epsilon, uniforms, used):
+
+        # explore with the first draw, pick the random action with the second, like
+        # the scripts' epsilon_greedy does from a RandomStream
+        if uniforms[used] < epsilon:
+            return int(uniforms[used+1] * n_valid), used + 2
+
+        # the first valid action with the highest value
+        action = 0
+        for a in range(1, n_valid):
+            if q[state, a] > q[state, action]:
+                action = a
+
+        return action, used + 1
+
+    @compile
+    def td_steps(next_state, reward, terminal, n_valid, q, sarsa, state, action, alpha, discount_factor,
+                 epsilon, uniforms, change, reward_sum):
+
+        # step until a terminal state is reached or fewer than 4 draws are left, so
+        # that the caller can hand in fresh draws and resume; the update sizes and
+        # rewards are added to the running sums of the episode in the order of the
+        # scripts' loops, so that the results are the same to the last bit
+        used = 0
+
+        while not terminal[state] and used + 4 <= len(uniforms):
+
+            if not sarsa:
+                action, used = epsilon_greedy(q, state, n_valid[state], epsilon, uniforms, used)
+
+            # follow the action and observe reward and next state
+            moved_to = next_state[state, action]
+            reward_sum += reward[state, action]
+
+            if sarsa:
+                next_action, used = epsilon_greedy(q, moved_to, n_valid[moved_to], epsilon, uniforms, used)
+                next_value = q[moved_to, next_action]
+            else:
+                next_action = -1
+                next_value = q[moved_to, 0]
+                for a in range(1, n_valid[moved_to]):
+                    next_value = max(next_value, q[moved_to, a])
+
+            # update the Q-value of the state-action
+            old_value = q[state, action]
+            new_value = old_value + alpha * (reward[state, action] + discount_factor * next_value - old_value)
+            q[state, action] = new_value
+
+            change += abs(new_value - old_value)
+
+            state = moved_to
+            action = next_action
+
+        return state, action, change, reward_sum, used
+
+    return epsilon_greedy, td_steps
+
+
+# the kernels only pay off compiled; without numba the scripts' own Python loops are faster
+compiled_kernels = build_kernels(njit) if njit is not None else None
+
+backends = ["python", "numba"]
+
+
+def kernel_backend(backend):
+
+    '''The backend that will actually run: "numba" falls back to "python" with a
+    warning when numba is not installed'''
+
+    if backend not in backends:
+        raise ValueError("Unknown backend: {} (one of {})".format(backend, backends))
+
+    if backend == "numba" and compiled_kernels is None:
+        warnings.warn("numba is not installed: falling back to the python backend")
+        return "python"
+
+    return backend
+
+
+def kernels():
+
+    '''The compiled (epsilon_greedy, td_steps) kernels'''
+
+    if compiled_kernels is None:
+        raise ValueError("The episode kernels need numba: use the python backend")
+
+    return compiled_kernels
+
+
+def run_kernel_episodes(environment, q, algorithm, episodes, alpha, discount_factor, epsilon, start_state,
+                        stream, monitor=None):
+
+    '''Train one agent on the Q array q (states, actions) with the numba-compiled episode kernels.
+    epsilon is a number or a function of the episode number and start_state a
+    function of the RandomStream that gives the starting state id. Consumes the
+    stream exactly like perform_sarsa/perform_qlearning, and returns their lists of
+    summed update sizes and rewards per episode. A ConvergenceMonitor can stop the
+    training early.'''
+
+    if algorithm not in ("sarsa", "qlearning"):
+        raise ValueError("Unknown algorithm: {}".format(algorithm))
+
+    epsilon_greedy, td_steps = kernels()
+    sarsa = algorithm == "sarsa"
+
+    if monitor is not None:
+        monitor.start()
+
+    change_per_episode = []
+    reward_per_episode = []
+
+    for time in range(1, episodes):
+
+        episode_epsilon = epsilon(time) if callable(epsilon) else epsilon
+
+        state = start_state(stream)
+        action = -1
+
+        if sarsa:
+            action, used = epsilon_greedy(q, state, environment.n_valid[state], episode_epsilon, stream.take(2), 0)
+            stream.advance(used)
+
+        change_in_episode = 0.0
+        reward_sum = 0
+
+        while not environment.terminal[state]:
+            state, action, change_in_episode, reward_sum, used = td_steps(
+                environment.next_state, environment.reward, environment.terminal, environment.n_valid, q, sarsa,
+                state, action, alpha, discount_factor, episode_epsilon, stream.take(4), change_in_episode, reward_sum)
+            stream.advance(used)
+
+        change_per_episode.append(change_in_episode)
+        reward_per_episode.append(int(reward_sum))
+
+        if monitor is not None and monitor.update(change_in_episode, q, environment.valid):
+            break
+
+    if monitor is not None:
+        monitor.finish()
+
+    return change_per_episode, reward_per_episode
+
+
+def batched_epsilon_greedy(q, replicas, states, epsilon, n_valid, rng):
+
+    '''Epsilon-greedy actions for many replicas at once: q is the (replicas, states,
+    actions) tensor and replicas/states are matching index arrays'''
+
+    values = q[replicas, states]
+    values = np.where(np.arange(values.shape[1]) < n_valid[states, None], values, -np.inf)
+    actions = values.argmax(axis=1)
+
+    # explore with probability epsilon: a random valid action
+    explore = rng.random(len(states)) < epsilon
+    actions[explore] = (rng.random(explore.sum()) * n_valid[states[explore]]).astype(np.int64)
+
+    return actions
+
+
+def run_batched_td(environment, algorithm, n_replicas, episodes, alpha, discount_factor, epsilon,
+                   start_states, initial_values=None, rng=None):
+
+    '''Train n_replicas independent SARSA or Q-learning agents in lockstep on one
+    (replicas, states, actions) Q tensor. Every episode all replicas start
+    together; each step advances all replicas that have not reached a terminal
+    state yet with fancy indexing, and finished replicas are masked out until
+    every replica has finished the episode.
+
+    epsilon is a number or a function of the episode number (starting at 1);
+    a start state is drawn uniformly from start_states for every replica and
+    episode. Like perform_sarsa/perform_qlearning, episodes-1 episodes are run.
+    Returns the Q tensor and the (replicas, episodes-1) arrays of summed update
+    sizes and summed rewards per episode.'''
+
+    if algorithm not in ("sarsa", "qlearning"):
+        raise ValueError("Unknown algorithm: {}".format(algorithm))
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    n_valid, valid = environment.n_valid, environment.valid
+    start_states = np.atleast_1d(start_states)
+
+    if initial_values is None:
+        q = np.zeros((n_replicas, environment.n_states, environment.n_actions))
+    else:
+        q = np.array(initial_values, dtype=float).reshape(n_replicas, environment.n_states, environment.n_actions)
+
+    change_per_episode = np.zeros((n_replicas, episodes-1))
+    reward_per_episode = np.zeros((n_replicas, episodes-1))
+
+    for time in range(1, episodes):
+
+        episode_epsilon = epsilon(time) if callable(epsilon) else epsilon
+
+        replicas = np.arange(n_replicas)
+        state = start_states[rng.integers(0, len(start_states), n_replicas)]
+
+        if algorithm == "sarsa":
+            action = batched_epsilon_greedy(q, replicas, state, episode_epsilon, n_valid, rng)
+
+        # only replicas that are not in a terminal state take a step
+        active = ~environment.terminal[state]
+        replicas, state = replicas[active], state[active]
+        if algorithm == "sarsa":
+            action = action[active]
+
+        while len(replicas):
+
+            if algorithm == "qlearning":
+                action = batched_epsilon_greedy(q, replicas, state, episode_epsilon, n_valid, rng)
+
+            # follow the actions and observe rewards and next states
+            next_state = environment.next_state[state, action]
+            reward = environment.reward[state, action]
+            reward_per_episode[replicas, time-1] += reward
+
+            if algorithm == "sarsa":
+                next_action = batched_epsilon_greedy(q, replicas, next_state, episode_epsilon, n_valid, rng)
+                next_value = q[replicas, next_state, next_action]
+            else:
+                next_value = np.where(valid[next_state], q[replicas, next_state], -np.inf).max(axis=1)
+
+            # update the Q-values of the state-actions
+            old_value = q[replicas, state, action]
+            new_value = old_value + alpha * (reward + discount_factor * next_value - old_value)
+            q[replicas, state, action] = new_value
+
+            change_per_episode[replicas, time-1] += np.abs(new_value - old_value)
+
+            # move on, dropping the replicas that reached a terminal state
+            active = ~environment.terminal[next_state]
+            replicas, state = replicas[active], next_state[active]
+            if algorithm == "sarsa":
+                action = next_action[active]
+
+    return q, change_per_episode, reward_per_episode
+
+
+class CurveStatistics():
+
+    '''Streaming per-episode statistics of many learning curves, added one curve or
+    one batch of curves at a time. Keeps the running mean and sum of squared
+    deviations (merged per batch, Chan et al.), so memory does not grow with the
+    number of curves. Curves may be shorter than length (runs that stopped early):
+    they only count for the episodes they ran, so count is kept per episode. With a
+    sample_size, a reservoir sample of that many whole curves is kept as well to
+    estimate quantiles.'''
+
+    def __init__(self, length, sample_size=0, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+
+        self.count = np.zeros(length, dtype=np.int64)
+        self.mean = np.zeros(length)
+        self.squares = np.zeros(length)
+
+        self.rng = rng
+        self.curves = 0
+        self.sample = np.full((sample_size, length), np.nan)
+
+    def add(self, curve):
+        self.add_batch(np.asarray(curve, dtype=float)[None, :])
+
+    def add_batch(self, curves):
+
+        '''Add a (curves, episodes) array of curves, episodes at most length'''
+
+        curves = np.asarray(curves, dtype=float)
+        n, episodes = curves.shape
+
+        if n == 0:
+            return
+
+        batch_mean = curves.mean(axis=0)
+        batch_squares = ((curves - batch_mean) ** 2).sum(axis=0)
+
+        old_count = self.count[:episodes]
+        count = old_count + n
+        delta = batch_mean - self.mean[:episodes]
+        self.mean[:episodes] += delta * n / count
+        self.squares[:episodes] += batch_squares + delta ** 2 * old_count * n / count
+        self.count[:episodes] = count
+
+        # reservoir sampling: every curve seen so far is in the sample with equal probability
+        for curve in curves:
+            slot = self.curves
+            if slot >= len(self.sample):
+                slot = self.rng.integers(0, self.curves + 1)
+
+            if slot < len(self.sample):
+                self.sample[slot] = np.nan
+                self.sample[slot, :episodes] = curve
+            self.curves += 1
+
+    def variance(self):
+
+        '''Population variance per episode (as np.var), NaN where no curve reached'''
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 0, self.squares / self.count, np.nan)
+
+    def std(self):
+        return np.sqrt(self.variance())
+
+    def quantile(self, q):
+
+        '''Quantile(s) per episode estimated from the reservoir sample'''
+
+        if not len(self.sample):
+            raise ValueError("No curves are sampled: pass a sample_size to keep quantiles")
+
+        # episodes that no sampled curve reached are NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanquantile(self.sample[:min(self.curves, len(self.sample))], q, axis=0)
+
+
+def curve_statistics(length, sample_size=0, rng=None):
+
+    '''Empty [change, rewards] pair of CurveStatistics for the results of one experiment'''
+
+    return [CurveStatistics(length, sample_size, rng), CurveStatistics(length, sample_size, rng)]
+
+
+class ResultStore():
+
+    '''Results of many (algorithm, epsilon) experiments on disk, one .npy file per
+    array: the per-episode "change" and "rewards" curves of shape (replicas,
+    episodes-1) and the final Q-values "q" of shape (replicas, states, actions).
+    Arrays start out as NaN and are filled in chunks of replicas through memory
+    maps, so that workers write their rows directly and only finished chunks
+    have to be recomputed. The settings of every experiment (seed, learning
+    parameters) are kept in a .json file next to the arrays, and the arrays are
+    started over when they change.'''
+
+    curves = ["change", "rewards"]
+    names = ["change", "q", "rewards"]
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, algorithm, epsilon, name):
+        return os.path.join(self.directory, "{}_epsilon{}_{}.npy".format(algorithm, epsilon, name))
+
+    def metadata_path(self, algorithm, epsilon):
+        return os.path.join(self.directory, "{}_epsilon{}_metadata.json".format(algorithm, epsilon))
+
+    def create(self, algorithm, epsilon, replicas, episodes, n_states, n_actions, metadata=None):
+
+        '''Allocate the arrays of an experiment, keeping them if they already have the
+        right shape and were computed with the same metadata (a JSON-serializable dict
+        of settings such as the seed and the learning parameters)'''
+
+        shapes = {"change": (replicas, episodes-1), "rewards": (replicas, episodes-1),
+                  "q": (replicas, n_states, n_actions)}
+
+        metadata = dict(metadata or {}, episodes=episodes)
+        metadata_path = self.metadata_path(algorithm, epsilon)
+
+        same_settings = False
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as file:
+                same_settings = json.load(file) == metadata
+
+        for name, shape in shapes.items():
+            path = self.path(algorithm, epsilon, name)
+
+            if same_settings and os.path.exists(path) and np.load(path, mmap_mode="r").shape == shape:
+                continue
+
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=float, shape=shape)
+            array[:] = np.nan
+            array.flush()
+
+        with open(metadata_path, "w") as file:
+            json.dump(metadata, file)
+
+    def done(self, algorithm, epsilon, start, stop):
+
+        '''Whether the replicas start..stop of an experiment have been written (in every array)'''
+
+        return not any(np.isnan(self.read(algorithm, epsilon, name)[start:stop]).any() for name in self.names)
+
+    def write(self, algorithm, epsilon, start, **arrays):
+
+        '''Write the rows of a chunk of replicas, starting at replica start. The arrays
+        are flushed in the order of ResultStore.names, rewards last.'''
+
+        for name in sorted(arrays, key=self.names.index):
+            values = arrays[name]
+            array = np.load(self.path(algorithm, epsilon, name), mmap_mode="r+")
+            array[start:start+len(values)] = values
+            array.flush()
+
+    def read(self, algorithm, epsilon, name):
+        return np.load(self.path(algorithm, epsilon, name), mmap_mode="r")